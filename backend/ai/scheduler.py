@@ -10,13 +10,22 @@ logger = logging.getLogger(__name__)
 _scheduler = None
 
 
-def start_scheduler(app):
-    """Initialize and start background scheduler within Flask app context."""
+def start_scheduler(app, ai_jobs=True):
+    """Initialize and start background scheduler within Flask app context.
+
+    ai_jobs=False registers only the roll-up refreshes — those are
+    idempotent (REFRESH ... CONCURRENTLY) so gunicorn workers can each
+    run a copy. The retrain and anomaly jobs are neither: duplicated
+    runs insert duplicate alerts, and the RandomForest fit is CPU-bound
+    enough to stall an eventlet worker's hub. Web workers must leave
+    them off; run them from a single dedicated process instead.
+    """
     global _scheduler
 
     try:
         from apscheduler.schedulers.background import BackgroundScheduler
         from apscheduler.triggers.cron import CronTrigger
+        from apscheduler.triggers.interval import IntervalTrigger
     except ImportError:
         logger.warning("[Scheduler] apscheduler not installed. Weekly retraining disabled.")
         return
@@ -53,13 +62,14 @@ def start_scheduler(app):
                 logger.error(f"[Scheduler] Retrain job error: {e}")
 
     # Run every Sunday at 02:00 UTC
-    _scheduler.add_job(
-        func=retrain_all_factories,
-        trigger=CronTrigger(day_of_week="sun", hour=2, minute=0),
-        id="weekly_retrain",
-        name="Weekly AI Model Retraining",
-        replace_existing=True,
-    )
+    if ai_jobs:
+        _scheduler.add_job(
+            func=retrain_all_factories,
+            trigger=CronTrigger(day_of_week="sun", hour=2, minute=0),
+            id="weekly_retrain",
+            name="Weekly AI Model Retraining",
+            replace_existing=True,
+        )
 
     # Also schedule daily anomaly detection at 06:00 UTC
     def daily_anomaly_scan():
@@ -81,16 +91,76 @@ def start_scheduler(app):
             except Exception as e:
                 logger.error(f"[Scheduler] Daily anomaly error: {e}")
 
+    if ai_jobs:
+        _scheduler.add_job(
+            func=daily_anomaly_scan,
+            trigger=CronTrigger(hour=6, minute=0),
+            id="daily_anomaly",
+            name="Daily Anomaly Detection",
+            replace_existing=True,
+        )
+
+    # Refresh the daily-report roll-ups just after day rollover, so
+    # yesterday moves from the live aggregation to the materialized
+    # views (and their memoized payloads get invalidated).
+    def refresh_report_rollups():
+        with app.app_context():
+            try:
+                from services.report_service import ReportService
+                ReportService.refresh_rollups()
+                logger.info("[Scheduler] Daily report roll-ups refreshed")
+            except Exception as e:
+                logger.error(f"[Scheduler] Report roll-up refresh error: {e}")
+
+    _scheduler.add_job(
+        func=refresh_report_rollups,
+        trigger=CronTrigger(hour=0, minute=10),
+        id="report_rollups",
+        name="Daily Report Roll-up Refresh",
+        replace_existing=True,
+    )
+
+    # Near-live PPM roll-up: /api/quality/ppm reads mv_factory_quality,
+    # so its staleness is bounded by this interval.
+    def refresh_quality_rollup():
+        with app.app_context():
+            try:
+                from services.quality_metrics_service import QualityMetricsService
+                QualityMetricsService.refresh_rollups()
+            except Exception as e:
+                logger.error(f"[Scheduler] Quality roll-up refresh error: {e}")
+
+    _scheduler.add_job(
+        func=refresh_quality_rollup,
+        trigger=IntervalTrigger(minutes=1),
+        id="quality_rollup",
+        name="PPM Roll-up Refresh",
+        replace_existing=True,
+    )
+
+    # The chatbot's PPM/trend/shift answers read factory_daily_metrics;
+    # five minutes comfortably outpaces its 7-day answer windows.
+    def refresh_chatbot_rollup():
+        with app.app_context():
+            try:
+                from services.chatbot_service import ChatbotService
+                ChatbotService.refresh_daily_metrics()
+            except Exception as e:
+                logger.error(f"[Scheduler] Chatbot roll-up refresh error: {e}")
+
     _scheduler.add_job(
-        func=daily_anomaly_scan,
-        trigger=CronTrigger(hour=6, minute=0),
-        id="daily_anomaly",
-        name="Daily Anomaly Detection",
+        func=refresh_chatbot_rollup,
+        trigger=IntervalTrigger(minutes=5),
+        id="chatbot_rollup",
+        name="Chatbot Daily-Metrics Refresh",
         replace_existing=True,
     )
 
     _scheduler.start()
-    logger.info("[Scheduler] Started — weekly retrain (Sun 02:00) + daily anomaly (06:00)")
+    jobs = "report roll-ups (00:10) + PPM roll-up (1 min) + chatbot metrics (5 min)"
+    if ai_jobs:
+        jobs = "weekly retrain (Sun 02:00) + daily anomaly (06:00) + " + jobs
+    logger.info(f"[Scheduler] Started — {jobs}")
     return _scheduler
 
 
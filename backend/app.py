@@ -3,6 +3,8 @@ QMS Enterprise — Main Flask Application v3.2
 Railway-compatible: single container, Flask serves API + static files
 """
 import os
+import decimal
+import dataclasses
 import logging
 from flask import Flask, send_from_directory, jsonify, abort
 from flask_cors import CORS
@@ -12,6 +14,38 @@ from models import db, bcrypt
 
 logger = logging.getLogger(__name__)
 
+# orjson-backed JSON provider: C-implemented dumps with native
+# date/datetime/numpy support — report and metrics payloads with
+# hundreds of floats serialize several times faster than the stdlib
+# encoder. orjson is a hard dependency (pinned in requirements.txt and
+# imported unconditionally by the routes/services), and the default
+# provider can't serialize the RowMapping payloads the services return.
+import orjson
+from flask.json.provider import JSONProvider
+
+
+class ORJSONProvider(JSONProvider):
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, decimal.Decimal):
+            return str(o)
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclasses.asdict(o)
+        if hasattr(o, "keys") and hasattr(o, "__getitem__"):
+            return dict(o)
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj,
+            default=self._default,
+            option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY,
+        ).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # ── Resolve paths ─────────────────────────────────────────────────
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 _FRONT_DIR = os.path.abspath(os.path.join(_BASE_DIR, '..', 'frontend'))
@@ -31,6 +65,8 @@ def create_app(config_name=None):
     )
     app.config.from_object(config[config_name])
 
+    app.json = ORJSONProvider(app)
+
     # ── Extensions ────────────────────────────────────────────────
     db.init_app(app)
     bcrypt.init_app(app)
@@ -44,7 +80,9 @@ def create_app(config_name=None):
         socketio = SocketIO(
             app,
             cors_allowed_origins="*",
-            async_mode="eventlet",
+            # eventlet only when wsgi.py has monkey-patched for it
+            # (QMS_USE_EVENTLET=1); threading mode otherwise
+            async_mode="eventlet" if os.environ.get('QMS_USE_EVENTLET') == '1' else "threading",
             logger=False,
             engineio_logger=False,
             path='/socket.io',
@@ -143,10 +181,19 @@ def create_app(config_name=None):
             return send_from_directory(_FRONT_DIR, 'index.html')
         return jsonify({"status": "ok", "message": "QMS Enterprise API"}), 200
 
-    # ── Background Scheduler (disabled for production start) ───────
-    # if not app.config.get('TESTING'):
-    #     from ai.scheduler import start_scheduler
-    #     start_scheduler(app)
+    # ── Background Scheduler ───────────────────────────────────────
+    # Runs in-process (one instance per worker) but registers only the
+    # roll-up refreshes: those use REFRESH ... CONCURRENTLY, so copies
+    # across workers are safe. The AI retrain/anomaly jobs are neither
+    # idempotent nor eventlet-friendly — QMS_SCHEDULER_AI_JOBS=1 opts a
+    # single dedicated process into them; web workers leave it unset.
+    # Opt-in via env so tests and one-off scripts stay quiet.
+    if os.environ.get('QMS_ENABLE_SCHEDULER') == '1' and not app.config.get('TESTING'):
+        try:
+            from ai.scheduler import start_scheduler
+            start_scheduler(app, ai_jobs=os.environ.get('QMS_SCHEDULER_AI_JOBS') == '1')
+        except Exception as e:
+            logger.error(f"Scheduler start error: {e}")
 
     # ── KPI broadcast helper ───────────────────────────────────────
     if socketio:
@@ -32,6 +32,8 @@ class Config:
         'pool_recycle':   300,
         'pool_size':      5,
         'max_overflow':   10,
+        # Identify this app in pg_stat_activity / pgbouncer logs
+        'connect_args':   {'application_name': 'qms-backend'},
     }
 
     # JWT
@@ -54,6 +56,11 @@ class Config:
     FRONTEND_URL = os.environ.get('FRONTEND_URL', '')
 
     # Auth
+    # bcrypt work factor. 10 is ~4× faster per check than the
+    # flask-bcrypt default of 12 and still above the OWASP floor;
+    # raise via env on hosts with CPU headroom. Existing hashes keep
+    # their embedded cost and verify unchanged.
+    BCRYPT_LOG_ROUNDS            = int(os.environ.get('BCRYPT_LOG_ROUNDS', 10))
     PASSWORD_RESET_EXPIRES_HOURS = 2
     MAX_LOGIN_ATTEMPTS           = 5
     LOCKOUT_DURATION_MINUTES     = 15
@@ -76,6 +83,8 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     TESTING     = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    # sqlite rejects postgres-only connect args
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=5)
 
 
@@ -0,0 +1,38 @@
+"""
+DB Middleware — QMS Enterprise
+Provides:
+  - readonly_route(f) — decorator: runs a pure-SELECT handler on a
+    READ ONLY transaction and rolls it back at the end
+"""
+from functools import wraps
+from models import db
+
+
+def readonly_route(f):
+    """
+    Mark a handler as pure-SELECT.
+
+    Begins the request's transaction with postgresql_readonly set, so
+    Postgres (and pgbouncer in transaction pooling mode) can skip the
+    write-path bookkeeping, and rolls back on exit so no transaction is
+    left open holding a pool slot.
+
+    Usage (innermost, after the auth decorator):
+        @token_required
+        @readonly_route
+        def my_route(current_user): ...
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        # token_required has already run User.query.get(), so the
+        # session's transaction is open and execution options set now
+        # would be silently ignored (with a SAWarning per request).
+        # The auth read needs nothing committed — roll it back so the
+        # handler's transaction starts fresh and actually READ ONLY.
+        db.session.rollback()
+        db.session.connection(execution_options={'postgresql_readonly': True})
+        try:
+            return f(*args, **kwargs)
+        finally:
+            db.session.rollback()
+    return decorated
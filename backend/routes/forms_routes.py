@@ -70,7 +70,9 @@ def submit_form(current_user, form_id):
 def get_responses(current_user, form_id):
     limit = int(request.args.get('limit', 100))
     offset = int(request.args.get('offset', 0))
+    fields_arg = request.args.get('fields')
+    fields = [f for f in fields_arg.split(',') if f] if fields_arg else None
     result = FormService.get_responses(
-        form_id, current_user["factory_id"], limit, offset
+        form_id, current_user["factory_id"], limit, offset, fields
     )
     return jsonify(result)
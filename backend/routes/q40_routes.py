@@ -1,8 +1,9 @@
 """
 Quality 4.0 Routes — IoT, SPC, Maintenance, Chatbot, Traceability, KPIs
 """
+import queue
 from datetime import date
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from middleware.auth_middleware import token_required
 from services.iot_service import IoTService, MaintenanceService
 from services.spc_service import SPCService
@@ -45,8 +46,11 @@ def ingest_sensor(current_user):
     readings = data.get('readings', [])
     if not device_id or not readings:
         return jsonify({"error": "device_id and readings required"}), 400
-    result = IoTService.ingest_sensor_data(fid(current_user), device_id, readings)
-    return jsonify(result), 201
+    try:
+        result = IoTService.ingest_sensor_data(fid(current_user), device_id, readings)
+    except queue.Full:
+        return jsonify({"error": "ingest queue full, retry later"}), 503
+    return jsonify(result), 202
 
 
 @q40_bp.route('/iot/summary', methods=['GET'])
@@ -69,6 +73,20 @@ def sensor_timeseries(current_user):
     return jsonify(data)
 
 
+@q40_bp.route('/iot/export', methods=['GET'])
+@token_required
+def sensor_export(current_user):
+    device_id = request.args.get('device_id', type=int)
+    metric = request.args.get('metric')
+    hours = int(request.args.get('hours', 24))
+    gen = IoTService.stream_sensor_readings(fid(current_user), device_id, metric, hours)
+    return Response(
+        stream_with_context(gen),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=sensor_readings.csv'},
+    )
+
+
 # ═══════════════════════════════════════════════════════
 # SPC — Statistical Process Control
 # ═══════════════════════════════════════════════════════
@@ -142,6 +160,13 @@ def predict_failure(current_user):
     return jsonify(data)
 
 
+@q40_bp.route('/maintenance/predict/all', methods=['GET'])
+@token_required
+def predict_failures_bulk(current_user):
+    data = MaintenanceService.predict_failures_bulk(fid(current_user))
+    return jsonify(data)
+
+
 @q40_bp.route('/maintenance/schedule', methods=['GET'])
 @token_required
 def maintenance_schedule(current_user):
@@ -221,6 +246,13 @@ def chatbot_query(current_user):
     return jsonify(result)
 
 
+@q40_bp.route('/chatbot/summary', methods=['GET'])
+@token_required
+def chatbot_summary(current_user):
+    """All dashboard metrics in a single DB round-trip."""
+    return jsonify(ChatbotService.get_dashboard_summary(fid(current_user)))
+
+
 @q40_bp.route('/chatbot/history', methods=['GET'])
 @token_required
 def chatbot_history(current_user):
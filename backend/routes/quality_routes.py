@@ -2,34 +2,55 @@
 Quality Metrics Routes
 GET /api/quality/metrics, /oee, /ppm, /trend, defect CRUD
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from flask import Blueprint, request, jsonify
+from functools import lru_cache
+from flask import Blueprint, Response, request, jsonify
 from middleware.auth_middleware import token_required
+from middleware.db_middleware import readonly_route
 from services.quality_metrics_service import QualityMetricsService
 from models import db
 from sqlalchemy import text
-import json
+from psycopg2.extras import Json
+import orjson
 
 quality_bp = Blueprint('quality', __name__)
 
 
-def _parse_dates(req):
-    start = req.args.get('start_date')
-    end = req.args.get('end_date')
+def _orjson_default(o):
+    # Serialize SQLAlchemy Row objects straight from their mapping view,
+    # so list endpoints skip the intermediate dict-of-dicts copy.
+    if hasattr(o, '_mapping'):
+        return dict(o._mapping)
+    return str(o)
+
+
+def _json_response(obj, status=200):
+    return Response(orjson.dumps(obj, default=_orjson_default),
+                    status=status, mimetype='application/json')
+
+
+@lru_cache(maxsize=256)
+def _iso(s):
+    # Dashboards poll the same date pair over and over; memoize so repeat
+    # requests skip both the parse and the try/except machinery.
+    if not s:
+        return None
     try:
-        if start:
-            start = date.fromisoformat(start)
-        if end:
-            end = date.fromisoformat(end)
+        return date.fromisoformat(s)
     except ValueError:
-        pass
-    return start, end
+        return None
+
+
+def _parse_dates(req):
+    return _iso(req.args.get('start_date')), _iso(req.args.get('end_date'))
 
 
 # ── Aggregate Metrics ─────────────────────────────────────────────────────────
 
 @quality_bp.route('/metrics', methods=['GET'])
 @token_required
+@readonly_route
 def get_metrics(current_user):
     start, end = _parse_dates(request)
     data = QualityMetricsService.get_comprehensive_metrics(
@@ -39,6 +60,7 @@ def get_metrics(current_user):
 
 @quality_bp.route('/oee', methods=['GET'])
 @token_required
+@readonly_route
 def get_oee(current_user):
     start, end = _parse_dates(request)
     machine_id = request.args.get('machine_id', type=int)
@@ -49,6 +71,7 @@ def get_oee(current_user):
 
 @quality_bp.route('/ppm', methods=['GET'])
 @token_required
+@readonly_route
 def get_ppm(current_user):
     start, end = _parse_dates(request)
     machine_id = request.args.get('machine_id', type=int)
@@ -59,6 +82,7 @@ def get_ppm(current_user):
 
 @quality_bp.route('/trend', methods=['GET'])
 @token_required
+@readonly_route
 def get_trend(current_user):
     period = request.args.get('period', 'daily')
     days = int(request.args.get('days', 30))
@@ -69,6 +93,7 @@ def get_trend(current_user):
 
 @quality_bp.route('/heatmap', methods=['GET'])
 @token_required
+@readonly_route
 def get_heatmap(current_user):
     start, end = _parse_dates(request)
     data = QualityMetricsService.get_machine_heatmap(
@@ -78,6 +103,7 @@ def get_heatmap(current_user):
 
 @quality_bp.route('/pareto', methods=['GET'])
 @token_required
+@readonly_route
 def get_pareto(current_user):
     start, end = _parse_dates(request)
     limit = int(request.args.get('limit', 10))
@@ -90,6 +116,7 @@ def get_pareto(current_user):
 
 @quality_bp.route('/defects', methods=['GET'])
 @token_required
+@readonly_route
 def get_defects(current_user):
     fid = current_user["factory_id"]
     start, end = _parse_dates(request)
@@ -138,11 +165,11 @@ def get_defects(current_user):
     total = db.session.execute(text(f"SELECT COUNT(*) FROM defect_records dr WHERE {where}"),
                                 params).scalar()
 
-    return jsonify({
+    return _json_response({
         "total": total,
         "limit": limit,
         "offset": offset,
-        "defects": [dict(r._mapping) for r in rows],
+        "defects": rows,
     })
 
 
@@ -223,9 +250,9 @@ def update_defect(current_user, defect_id):
     """), {
         "dr_id": defect_id,
         "user_id": current_user["id"],
-        "fields": json.dumps(list(new_dict.keys())),
-        "old_vals": json.dumps(old_dict),
-        "new_vals": json.dumps(new_dict),
+        "fields": Json(list(new_dict.keys())),
+        "old_vals": Json(old_dict),
+        "new_vals": Json(new_dict),
     })
     db.session.commit()
     return jsonify({"message": "Updated"})
@@ -246,12 +273,13 @@ def delete_defect(current_user, defect_id):
 
 @quality_bp.route('/machines', methods=['GET'])
 @token_required
+@readonly_route
 def get_machines(current_user):
     rows = db.session.execute(text("""
         SELECT id, code, name, location, is_active, created_at
         FROM machines WHERE factory_id = :fid AND deleted_at IS NULL ORDER BY code
     """), {"fid": current_user["factory_id"]}).fetchall()
-    return jsonify([dict(r._mapping) for r in rows])
+    return _json_response(rows)
 
 
 @quality_bp.route('/machines', methods=['POST'])
@@ -273,45 +301,63 @@ def create_machine(current_user):
 
 # ── KPIs (Dashboard Aggregate) ────────────────────────────────────────────────
 
+def _kpi_query(engine, sql, params):
+    # Each future gets its own pool connection — db.session is not
+    # thread-safe and must not be shared across the executor. The engine
+    # is resolved in the request thread and passed in, because looking
+    # up db.engine needs an app context the executor threads don't have.
+    with engine.connect() as conn:
+        return conn.execute(text(sql), params).fetchone()
+
+
 @quality_bp.route('/kpis', methods=['GET'])
 @token_required
+@readonly_route
 def get_kpis(current_user):
     """GET /api/quality/kpis?days=30 — Aggregate KPIs for dashboard."""
     days = int(request.args.get('days', 30))
     fid  = current_user["factory_id"]
-
-    ppm_row = db.session.execute(text("""
-        SELECT
-            CASE WHEN SUM(quantity_produced) > 0
-                 THEN SUM(quantity_defective)::FLOAT / SUM(quantity_produced) * 1000000
-                 ELSE 0 END AS ppm,
-            SUM(quantity_defective)  AS total_defective,
-            SUM(quantity_produced)   AS total_produced,
-            COUNT(*)                 AS record_count
-        FROM defect_records
-        WHERE factory_id = :fid
-          AND deleted_at IS NULL
-          AND defect_date >= CURRENT_DATE - :days * INTERVAL '1 day'
-    """), {"fid": fid, "days": days}).fetchone()
-
-    ppm = float(ppm_row.ppm or 0)
-    fpy = round(max(0, 100 - ppm / 10000), 2)
-
-    # Try OEE table, fallback to defaults
-    try:
-        oee_row = db.session.execute(text("""
+    params = {"fid": fid, "days": days}
+    engine = db.engine
+
+    # The two aggregates touch disjoint tables — run them concurrently
+    # so the handler waits max(t_defect, t_oee) instead of the sum.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        ppm_future = pool.submit(_kpi_query, engine, """
+            SELECT
+                CASE WHEN SUM(quantity_produced) > 0
+                     THEN SUM(quantity_defective)::FLOAT / SUM(quantity_produced) * 1000000
+                     ELSE 0 END AS ppm,
+                SUM(quantity_defective)  AS total_defective,
+                SUM(quantity_produced)   AS total_produced,
+                COUNT(*)                 AS record_count
+            FROM defect_records
+            WHERE factory_id = :fid
+              AND deleted_at IS NULL
+              AND defect_date >= CURRENT_DATE - :days * INTERVAL '1 day'
+        """, params)
+        oee_future = pool.submit(_kpi_query, engine, """
             SELECT AVG(COALESCE(availability_pct,88)) AS availability,
                    AVG(COALESCE(performance_pct,93))  AS performance,
                    AVG(COALESCE(quality_pct,99.8))    AS quality_pct
             FROM oee_records
             WHERE factory_id = :fid
               AND record_date >= CURRENT_DATE - :days * INTERVAL '1 day'
-        """), {"fid": fid, "days": days}).fetchone()
-        avail = float(oee_row.availability or 88)
-        perf  = float(oee_row.performance  or 93)
-        qual  = float(oee_row.quality_pct  or 99.8)
-    except Exception:
-        avail, perf, qual = 88.0, 93.0, 99.8
+        """, params)
+
+        ppm_row = ppm_future.result()
+
+        ppm = float(ppm_row.ppm or 0)
+        fpy = round(max(0, 100 - ppm / 10000), 2)
+
+        # OEE table may not exist yet — fallback to defaults
+        try:
+            oee_row = oee_future.result()
+            avail = float(oee_row.availability or 88)
+            perf  = float(oee_row.performance  or 93)
+            qual  = float(oee_row.quality_pct  or 99.8)
+        except Exception:
+            avail, perf, qual = 88.0, 93.0, 99.8
 
     oee = round(avail * perf * qual / 10000, 2)
 
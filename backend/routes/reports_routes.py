@@ -3,7 +3,8 @@ Reports Routes
 GET /api/reports/daily, /monthly, /supplier, /export
 """
 from datetime import date
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response, \
+    stream_with_context, current_app
 from middleware.auth_middleware import token_required
 from services.report_service import ReportService
 from io import BytesIO
@@ -35,11 +36,21 @@ def monthly_report(current_user):
 def supplier_report(current_user):
     start = request.args.get('start_date')
     end = request.args.get('end_date')
+    start = date.fromisoformat(start) if start else None
+    end = date.fromisoformat(end) if end else None
+
+    # ?stream=1 emits NDJSON row by row while the DB is still producing
+    if request.args.get('stream') == '1':
+        gen = ReportService.stream_supplier_quality(
+            current_user["factory_id"], start, end)
+        dumps = current_app.json.dumps
+        return Response(
+            stream_with_context(dumps(row) + "\n" for row in gen),
+            mimetype='application/x-ndjson',
+        )
+
     data = ReportService.get_supplier_quality(
-        current_user["factory_id"],
-        date.fromisoformat(start) if start else None,
-        date.fromisoformat(end) if end else None,
-    )
+        current_user["factory_id"], start, end)
     return jsonify(data)
 
 
@@ -63,3 +74,29 @@ def export_report(current_user):
             return jsonify({"error": str(e)}), 400
     else:
         return jsonify({"error": "Unsupported format. Use format=excel"}), 400
+
+
+@reports_bp.route('/export/async', methods=['POST'])
+@token_required
+def export_report_async(current_user):
+    report_type = request.args.get('type', 'daily')
+    job = ReportService.generate_excel_report_async(
+        current_user["factory_id"], report_type)
+    return jsonify(job), 202
+
+
+@reports_bp.route('/export/jobs/<job_id>', methods=['GET'])
+@token_required
+def export_job_status(current_user, job_id):
+    job = ReportService.get_export_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] != "done":
+        return jsonify({"job_id": job_id, "status": job["status"],
+                        "error": job["error"]})
+    return send_file(
+        job["path"],
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f"qms_report_{job_id}.xlsx"
+    )
@@ -8,12 +8,14 @@ from models import db
 from models.user_model import User, AuditLog
 from models.role_model import Role, Permission
 from middleware.auth_middleware import require_permission
+from middleware.db_middleware import readonly_route
 
 role_bp = Blueprint('roles', __name__)
 
 
 @role_bp.route('/', methods=['GET'])
 @jwt_required()
+@readonly_route
 def list_roles():
     """GET /api/roles/ — Factory-scoped"""
     current_user_id = get_jwt_identity()
@@ -112,6 +114,7 @@ def delete_role(role_id):
 
 @role_bp.route('/permissions', methods=['GET'])
 @jwt_required()
+@readonly_route
 def list_permissions():
     """GET /api/roles/permissions — All available permissions"""
     permissions = Permission.query.all()
@@ -3,16 +3,19 @@ User Routes Blueprint
 """
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy import text
 
 from models import db, bcrypt
 from models.user_model import User, AuditLog
 from middleware.auth_middleware import require_permission
+from middleware.db_middleware import readonly_route
 
 user_bp = Blueprint('users', __name__)
 
 
 @user_bp.route('/me', methods=['GET'])
 @jwt_required()
+@readonly_route
 def get_me():
     """GET /api/users/me"""
     user_id = get_jwt_identity()
@@ -66,6 +69,7 @@ def update_me():
 @user_bp.route('/', methods=['GET'])
 @jwt_required()
 @require_permission('users.view')
+@readonly_route
 def list_users():
     """GET /api/users/ — Factory-scoped"""
     current_user_id = get_jwt_identity()
@@ -88,6 +92,7 @@ def list_users():
 @user_bp.route('/<int:user_id>', methods=['GET'])
 @jwt_required()
 @require_permission('users.view')
+@readonly_route
 def get_user(user_id):
     """GET /api/users/<id>"""
     current_user_id = get_jwt_identity()
@@ -102,18 +107,21 @@ def get_user(user_id):
 @jwt_required()
 @require_permission('users.edit')
 def toggle_user_active(user_id):
-    """Toggle user active status."""
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(int(current_user_id))
-    user = User.query.filter_by(id=user_id, factory_id=current_user.factory_id).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.id == current_user.id:
-        return jsonify({'error': 'Cannot deactivate yourself'}), 400
-
-    user.is_active = not user.is_active
+    """Toggle user active status with a single UPDATE ... RETURNING."""
+    current_user_id = int(get_jwt_identity())
+    # Flip the bit server-side; the id<>:me guard makes the
+    # self-deactivation check race-free.
+    row = db.session.execute(text("""
+        UPDATE users SET is_active = NOT is_active
+        WHERE id = :uid AND id <> :me
+          AND factory_id = (SELECT factory_id FROM users WHERE id = :me)
+        RETURNING id, is_active, name, email
+    """), {"uid": user_id, "me": current_user_id}).fetchone()
     db.session.commit()
-    return jsonify({'message': f'User {"activated" if user.is_active else "deactivated"}', 'user': user.to_dict()}), 200
+    if not row:
+        return jsonify({'error': 'User not found or cannot deactivate yourself'}), 400
+    return jsonify({'message': f'User {"activated" if row.is_active else "deactivated"}',
+                    'user': dict(row._mapping)}), 200
 
 
 @user_bp.route('/me/password', methods=['PUT'])
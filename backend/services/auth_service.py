@@ -2,25 +2,53 @@
 Authentication Service Layer — QMS Enterprise
 Handles all auth business logic: login, register, tokens, password reset.
 """
+import hashlib
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from flask import current_app
 from flask_jwt_extended import create_access_token, create_refresh_token
+from sqlalchemy.orm import joinedload
 
 from models import db, bcrypt
 from models.user_model import User, PasswordReset, RefreshToken, AuditLog
 from models.factory_model import Factory
 from models.role_model import Role
 
+# Post-login bookkeeping (refresh-token insert + audit log) runs here so
+# the bcrypt-bound login path returns as soon as tokens are minted
+_login_writer = ThreadPoolExecutor(max_workers=4, thread_name_prefix='auth-writes')
+
+# Lazily-built bcrypt hash checked when the account doesn't exist, so a
+# missing email costs the same as a wrong password (no timing oracle)
+_dummy_hash = None
+
+
+def _token_digest(token: str) -> bytes:
+    # hashlib dispatches to OpenSSL (SHA-NI where available)
+    return hashlib.sha256(token.encode()).digest()
+
+
+def _get_dummy_hash() -> str:
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = bcrypt.generate_password_hash(secrets.token_hex(16)).decode('utf-8')
+    return _dummy_hash
+
 
 class AuthService:
 
     @staticmethod
     def login(email: str, password: str, ip_address: str = None) -> dict:
         """Authenticate user, return tokens + user data."""
-        user = User.query.filter_by(email=email.lower().strip()).first()
+        # Eager-load factory + role: additional_claims below touches both,
+        # which otherwise costs two lazy-load SELECTs
+        user = User.query.options(
+            joinedload(User.factory), joinedload(User.role)
+        ).filter_by(email=email.lower().strip()).first()
 
         if not user:
+            bcrypt.check_password_hash(_get_dummy_hash(), password)
             raise ValueError('Invalid credentials')
 
         if user.is_locked():
@@ -62,10 +90,9 @@ class AuthService:
         refresh_token = create_refresh_token(identity=str(user.id))
 
         expires_at = datetime.utcnow() + current_app.config['JWT_REFRESH_TOKEN_EXPIRES']
-        db.session.add(RefreshToken(user_id=user.id, token=refresh_token, expires_at=expires_at))
-        db.session.commit()
-
-        AuthService._log(user.id, 'login_success', 'auth', {}, ip_address, user.factory_id)
+        _login_writer.submit(
+            AuthService._post_login_writes, current_app._get_current_object(),
+            user.id, refresh_token, expires_at, ip_address, user.factory_id)
 
         return {
             'access_token':  access_token,
@@ -73,6 +100,26 @@ class AuthService:
             'user':          user.to_dict()
         }
 
+    @staticmethod
+    def _post_login_writes(app, user_id, refresh_token, expires_at,
+                           ip_address, factory_id):
+        """Persist the refresh token + audit log off the request thread.
+
+        Runs in its own app context so the worker thread gets its own
+        scoped session rather than sharing the request's.
+        """
+        with app.app_context():
+            try:
+                db.session.add(RefreshToken(
+                    user_id=user_id, token=refresh_token,
+                    token_sha256=_token_digest(refresh_token),
+                    expires_at=expires_at))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+            AuthService._log(user_id, 'login_success', 'auth', {},
+                             ip_address, factory_id)
+
     @staticmethod
     def register(name: str, email: str, password: str, factory_id: int,
                  ip_address: str = None) -> dict:
@@ -98,7 +145,7 @@ class AuthService:
             is_active=True,
         )
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()  # need user.id for tokens below
 
         additional_claims = {
             'name':         user.name,
@@ -111,11 +158,15 @@ class AuthService:
         refresh_token = create_refresh_token(identity=str(user.id))
 
         expires_at = datetime.utcnow() + current_app.config['JWT_REFRESH_TOKEN_EXPIRES']
-        db.session.add(RefreshToken(user_id=user.id, token=refresh_token, expires_at=expires_at))
+        db.session.add(RefreshToken(user_id=user.id, token=refresh_token,
+                                    token_sha256=_token_digest(refresh_token),
+                                    expires_at=expires_at))
+        db.session.add(AuditLog(user_id=user.id, action='user_registered', module='auth',
+                                details={'email': email}, ip_address=ip_address,
+                                factory_id=factory_id))
+        # One transaction, one WAL fsync
         db.session.commit()
 
-        AuthService._log(user.id, 'user_registered', 'auth', {'email': email}, ip_address, factory_id)
-
         return {
             'access_token':  access_token,
             'refresh_token': refresh_token,
@@ -165,7 +216,7 @@ class AuthService:
             email_verified=True,
         )
         db.session.add(admin_user)
-        db.session.commit()
+        db.session.flush()  # need admin_user.id for tokens below
 
         additional_claims = {
             'name':         admin_user.name,
@@ -178,12 +229,15 @@ class AuthService:
         refresh_token = create_refresh_token(identity=str(admin_user.id))
 
         expires_at = datetime.utcnow() + current_app.config['JWT_REFRESH_TOKEN_EXPIRES']
-        db.session.add(RefreshToken(user_id=admin_user.id, token=refresh_token, expires_at=expires_at))
+        db.session.add(RefreshToken(user_id=admin_user.id, token=refresh_token,
+                                    token_sha256=_token_digest(refresh_token),
+                                    expires_at=expires_at))
+        db.session.add(AuditLog(user_id=admin_user.id, action='admin_registered', module='auth',
+                                details={'factory': factory_name}, ip_address=ip_address,
+                                factory_id=factory.id))
+        # One transaction, one WAL fsync
         db.session.commit()
 
-        AuthService._log(admin_user.id, 'admin_registered', 'auth',
-                         {'factory': factory_name}, ip_address, factory.id)
-
         return {
             'access_token':  access_token,
             'refresh_token': refresh_token,
@@ -194,16 +248,24 @@ class AuthService:
     @staticmethod
     def refresh_tokens(refresh_token_str: str, ip_address: str = None) -> dict:
         """Rotate refresh token, issue new access token."""
-        db_token = RefreshToken.query.filter_by(token=refresh_token_str).first()
-
-        if not db_token or not db_token.is_valid():
+        # One round-trip: token row + user + factory/role eager-loaded,
+        # instead of token SELECT, user SELECT, then two lazy loads
+        pair = db.session.query(RefreshToken, User).join(
+            User, User.id == RefreshToken.user_id
+        ).options(
+            joinedload(User.factory), joinedload(User.role)
+        ).filter(
+            RefreshToken.token_sha256 == _token_digest(refresh_token_str)
+        ).first()
+
+        if not pair or not pair[0].is_valid():
             raise PermissionError('Invalid or expired refresh token')
 
-        user = User.query.get(db_token.user_id)
-        if not user or not user.is_active:
+        db_token, user = pair
+        if not user.is_active:
             raise PermissionError('User not found or inactive')
 
-        db_token.revoked = True
+        RefreshToken.query.filter_by(id=db_token.id).update({'revoked': True})
 
         additional_claims = {
             'name':         user.name,
@@ -216,7 +278,9 @@ class AuthService:
         new_refresh   = create_refresh_token(identity=str(user.id))
 
         expires_at = datetime.utcnow() + current_app.config['JWT_REFRESH_TOKEN_EXPIRES']
-        db.session.add(RefreshToken(user_id=user.id, token=new_refresh, expires_at=expires_at))
+        db.session.add(RefreshToken(user_id=user.id, token=new_refresh,
+                                    token_sha256=_token_digest(new_refresh),
+                                    expires_at=expires_at))
         db.session.commit()
 
         return {'access_token': access_token, 'refresh_token': new_refresh}
@@ -227,7 +291,8 @@ class AuthService:
         if not user:
             return None
 
-        PasswordReset.query.filter_by(user_id=user.id, used=False).update({'used': True})
+        PasswordReset.query.filter_by(user_id=user.id, used=False).update(
+            {'used': True}, synchronize_session=False)
 
         token = secrets.token_urlsafe(32)
         expires_hours = current_app.config.get('PASSWORD_RESET_EXPIRES_HOURS', 2)
@@ -253,7 +318,8 @@ class AuthService:
         user.locked_until   = None
         reset.used = True
 
-        RefreshToken.query.filter_by(user_id=user.id).update({'revoked': True})
+        RefreshToken.query.filter_by(user_id=user.id, revoked=False).update(
+            {'revoked': True}, synchronize_session=False)
         db.session.commit()
         return True
 
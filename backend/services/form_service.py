@@ -2,24 +2,92 @@
 Dynamic Form Engine Service
 Handles form CRUD, field management, response submission, and validation
 """
+import ast
+import csv
+import io
 import json
+import orjson
 from datetime import datetime
 from typing import Optional
 from models import db
+from psycopg2.extras import execute_values
 from sqlalchemy import text
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Form schemas keyed by (form_id, factory_id, version). A version bump
+# changes the key, so stale entries simply stop being hit; a cheap
+# primary-key version SELECT decides hit/miss on every load.
+_form_cache = {}
+_FORM_CACHE_MAX = 1024
+
+# Calculated-field formulas, parsed + validated once and kept as code
+# objects keyed by the formula text itself — content-addressed, so an
+# edited formula simply misses the cache and no invalidation is needed
+_formula_cache = {}
+
+_ALLOWED_FORMULA_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd,
+)
+
+
+def _compile_formula(formula: str):
+    """Return a compiled code object for an arithmetic-only formula.
+
+    Rejects anything beyond names, numbers, and arithmetic operators,
+    so attribute access, calls, and subscripts can never reach eval.
+    """
+    code = _formula_cache.get(formula)
+    if code is None:
+        tree = ast.parse(formula, mode="eval")
+        for node in ast.walk(tree):
+            if not isinstance(node, _ALLOWED_FORMULA_NODES):
+                raise ValueError(f"Unsupported formula element: {type(node).__name__}")
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError("Only numeric constants are allowed in formulas")
+        code = compile(tree, "<formula>", "eval")
+        _formula_cache[formula] = code
+    return code
+
 
 class FormService:
 
+    # At this many fields, creation switches from a multi-row INSERT to
+    # Postgres COPY
+    _COPY_THRESHOLD = 100
+
+    _FIELD_COLUMNS = (
+        "form_id", "label", "field_key", "field_type", "is_required",
+        "order_index", "validation_rules", "options", "conditional_logic",
+        "calculation_formula", "placeholder", "help_text",
+    )
+
+    @staticmethod
+    def _copy_fields(field_params: list) -> None:
+        """Bulk-load form_fields via COPY on the session's connection.
+
+        Runs inside the session transaction, so the caller's commit (or
+        rollback) still covers it.
+        """
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for p in field_params:
+            writer.writerow(
+                ["\\N" if p[c] is None else p[c] for c in FormService._FIELD_COLUMNS])
+        buf.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            "COPY form_fields ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+                ", ".join(FormService._FIELD_COLUMNS)), buf)
+
     @staticmethod
     def create_form(factory_id: int, user_id: int, data: dict) -> dict:
         sql = """
             INSERT INTO forms (name, description, module, factory_id, is_active, version)
             VALUES (:name, :description, :module, :factory_id, TRUE, 1)
-            RETURNING id, name, module, factory_id, version, created_at
+            RETURNING id, name, description, module, factory_id, is_active, version, created_at
         """
         row = db.session.execute(text(sql), {
             "name": data["name"],
@@ -29,32 +97,75 @@ class FormService:
         }).fetchone()
         form_id = row.id
 
-        # Insert fields
-        for idx, field in enumerate(data.get("fields", [])):
-            db.session.execute(text("""
-                INSERT INTO form_fields
-                    (form_id, label, field_key, field_type, is_required, order_index,
-                     validation_rules, options, conditional_logic, calculation_formula, placeholder, help_text)
-                VALUES
-                    (:form_id, :label, :field_key, :field_type, :is_required, :order_index,
-                     :validation_rules, :options, :conditional_logic, :calculation_formula, :placeholder, :help_text)
-            """), {
+        # Insert fields — build all parameter rows first, then one
+        # executemany round-trip instead of one INSERT per field
+        field_params = [
+            {
                 "form_id": form_id,
                 "label": field["label"],
                 "field_key": field.get("field_key", field["label"].lower().replace(" ", "_")),
                 "field_type": field.get("field_type", "text"),
                 "is_required": field.get("is_required", False),
                 "order_index": field.get("order_index", idx),
-                "validation_rules": json.dumps(field.get("validation_rules", {})),
-                "options": json.dumps(field.get("options", [])),
-                "conditional_logic": json.dumps(field.get("conditional_logic", {})),
+                "validation_rules": orjson.dumps(field.get("validation_rules", {})).decode(),
+                "options": orjson.dumps(field.get("options", [])).decode(),
+                "conditional_logic": orjson.dumps(field.get("conditional_logic", {})).decode(),
                 "calculation_formula": field.get("calculation_formula"),
                 "placeholder": field.get("placeholder"),
                 "help_text": field.get("help_text"),
-            })
+            }
+            for idx, field in enumerate(data.get("fields", []))
+        ]
+        id_rows = []
+        if len(field_params) >= FormService._COPY_THRESHOLD:
+            # Template imports can carry hundreds of fields; COPY skips
+            # per-row planning and writes a fraction of the WAL
+            FormService._copy_fields(field_params)
+            id_rows = db.session.execute(text(
+                "SELECT id, order_index FROM form_fields WHERE form_id = :form_id"
+            ), {"form_id": form_id}).fetchall()
+        elif field_params:
+            # execute_values with fetch=True: one multi-row INSERT that
+            # also hands back the generated ids (textual executemany
+            # can't carry RETURNING)
+            cursor = db.session.connection().connection.cursor()
+            id_rows = execute_values(cursor, """
+                INSERT INTO form_fields ({})
+                VALUES %s
+                RETURNING id, order_index
+            """.format(", ".join(FormService._FIELD_COLUMNS)),
+                [tuple(p[c] for c in FormService._FIELD_COLUMNS) for p in field_params],
+                fetch=True)
 
         db.session.commit()
-        return FormService.get_form(form_id, factory_id)
+
+        # Everything needed for the response is already in hand (the
+        # forms RETURNING row, the input fields, and the new field ids)
+        # — no need to re-SELECT via get_form
+        id_by_order = {int(order_idx): int(field_id) for field_id, order_idx in id_rows}
+        form_dict = dict(row._mapping)
+        form_dict["fields"] = [
+            {
+                "id": id_by_order.get(p["order_index"]),
+                "label": p["label"],
+                "field_key": p["field_key"],
+                "field_type": p["field_type"],
+                "is_required": p["is_required"],
+                "order_index": p["order_index"],
+                "validation_rules": field.get("validation_rules", {}),
+                "options": field.get("options", []),
+                "conditional_logic": field.get("conditional_logic", {}),
+                "calculation_formula": p["calculation_formula"],
+                "placeholder": p["placeholder"],
+                "help_text": p["help_text"],
+            }
+            for field, p in zip(data.get("fields", []), field_params)
+        ]
+
+        if len(_form_cache) >= _FORM_CACHE_MAX:
+            _form_cache.clear()
+        _form_cache[(form_id, factory_id, form_dict["version"])] = form_dict
+        return form_dict
 
     @staticmethod
     def get_forms(factory_id: int, module: Optional[str] = None) -> list:
@@ -75,11 +186,25 @@ class FormService:
             GROUP BY f.id
             ORDER BY f.created_at DESC
         """
-        rows = db.session.execute(text(sql), params).fetchall()
-        return [dict(r._mapping) for r in rows]
+        # RowMapping serializes through jsonify directly — no per-row
+        # dict() boxing needed
+        return db.session.execute(text(sql), params).mappings().all()
 
     @staticmethod
     def get_form(form_id: int, factory_id: int) -> Optional[dict]:
+        version = db.session.execute(text("""
+            SELECT version FROM forms
+            WHERE id = :id AND factory_id = :factory_id AND deleted_at IS NULL
+        """), {"id": form_id, "factory_id": factory_id}).scalar()
+
+        if version is None:
+            return None
+
+        cache_key = (form_id, factory_id, version)
+        cached = _form_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         row = db.session.execute(text("""
             SELECT id, name, description, module, factory_id, is_active, version, created_at
             FROM forms WHERE id = :id AND factory_id = :factory_id AND deleted_at IS NULL
@@ -98,9 +223,28 @@ class FormService:
         """), {"form_id": form_id}).fetchall()
 
         form_dict = dict(row._mapping)
-        form_dict["fields"] = [dict(f._mapping) for f in fields]
+        # Normalize JSON columns to native structures here, once per
+        # form load, so validation never re-parses them per submission
+        field_dicts = []
+        for f in fields:
+            fd = dict(f._mapping)
+            fd["validation_rules"] = FormService._as_json(fd["validation_rules"], {})
+            fd["options"] = FormService._as_json(fd["options"], [])
+            fd["conditional_logic"] = FormService._as_json(fd["conditional_logic"], {})
+            field_dicts.append(fd)
+        form_dict["fields"] = field_dicts
+
+        if len(_form_cache) >= _FORM_CACHE_MAX:
+            _form_cache.clear()
+        _form_cache[cache_key] = form_dict
         return form_dict
 
+    @staticmethod
+    def _as_json(val, default):
+        if isinstance(val, str):
+            return json.loads(val) if val else default
+        return val if val is not None else default
+
     @staticmethod
     def submit_response(form_id: int, factory_id: int, user_id: int,
                         data: dict) -> dict:
@@ -126,9 +270,10 @@ class FormService:
             # Compute calculated fields
             if field["field_type"] == "calculated" and field["calculation_formula"]:
                 try:
-                    formula = field["calculation_formula"]
-                    # Safe eval with limited scope
-                    calc_val = eval(formula, {"__builtins__": {}}, response_data)
+                    # Compiled once per distinct formula; eval only ever
+                    # sees AST-validated arithmetic
+                    code = _compile_formula(field["calculation_formula"])
+                    calc_val = eval(code, {"__builtins__": {}}, response_data)
                     response_data[key] = round(float(calc_val), 4) if calc_val else 0
                 except Exception as e:
                     logger.warning(f"Calculation failed for {key}: {e}")
@@ -136,8 +281,6 @@ class FormService:
             # Validate number ranges
             if field["field_type"] == "number" and val is not None:
                 rules = field.get("validation_rules") or {}
-                if isinstance(rules, str):
-                    rules = json.loads(rules) if rules else {}
                 if "min" in rules and float(val) < float(rules["min"]):
                     errors.append(f"Field '{field['label']}' must be ≥ {rules['min']}")
                 if "max" in rules and float(val) > float(rules["max"]):
@@ -167,26 +310,44 @@ class FormService:
 
     @staticmethod
     def get_responses(form_id: int, factory_id: int, limit: int = 100,
-                      offset: int = 0) -> dict:
-        total = db.session.execute(text("""
-            SELECT COUNT(*) FROM form_responses
-            WHERE form_id = :form_id AND factory_id = :factory_id AND deleted_at IS NULL
-        """), {"form_id": form_id, "factory_id": factory_id}).scalar()
-
-        rows = db.session.execute(text("""
-            SELECT fr.id, fr.submitted_at, fr.data, u.name AS submitted_by
+                      offset: int = 0, fields: Optional[list] = None) -> dict:
+        params = {"form_id": form_id, "factory_id": factory_id,
+                  "limit": limit, "offset": offset}
+
+        # When the caller only renders a few keys (list views), project
+        # them out of the jsonb server-side instead of shipping every
+        # response blob over the wire. Keys are bound, never interpolated.
+        if fields:
+            pairs = ", ".join(f":fk{i}, fr.data -> :fk{i}" for i in range(len(fields)))
+            data_expr = f"jsonb_build_object({pairs}) AS data"
+            params.update({f"fk{i}": key for i, key in enumerate(fields)})
+        else:
+            data_expr = "fr.data"
+
+        # COUNT(*) OVER () rides the same scan as the page itself, so
+        # total + rows cost one query instead of two
+        rows = db.session.execute(text(f"""
+            SELECT fr.id, fr.submitted_at, {data_expr}, u.name AS submitted_by,
+                   COUNT(*) OVER () AS total_count
             FROM form_responses fr
             LEFT JOIN users u ON u.id = fr.user_id
             WHERE fr.form_id = :form_id AND fr.factory_id = :factory_id AND fr.deleted_at IS NULL
             ORDER BY fr.submitted_at DESC
             LIMIT :limit OFFSET :offset
-        """), {"form_id": form_id, "factory_id": factory_id, "limit": limit, "offset": offset}).fetchall()
+        """), params).fetchall()
+
+        total = int(rows[0].total_count) if rows else 0
+        responses = []
+        for r in rows:
+            d = dict(r._mapping)
+            d.pop("total_count", None)
+            responses.append(d)
 
         return {
             "total": total,
             "limit": limit,
             "offset": offset,
-            "responses": [dict(r._mapping) for r in rows],
+            "responses": responses,
         }
 
     @staticmethod
@@ -197,4 +358,6 @@ class FormService:
             WHERE id = :id AND factory_id = :factory_id AND deleted_at IS NULL
         """), {"id": form_id, "factory_id": factory_id})
         db.session.commit()
+        for key in [k for k in _form_cache if k[0] == form_id]:
+            _form_cache.pop(key, None)
         return result.rowcount > 0
@@ -2,15 +2,94 @@
 IoT Service — Sensor data ingestion, retrieval, and aggregation
 Predictive Maintenance — MTBF, MTTR, failure probability
 """
+import csv
+import io
 import json
 import logging
+import queue
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Optional, List
+import numpy as np
+from flask import current_app
 from sqlalchemy import text
 from models import db
 
 logger = logging.getLogger(__name__)
 
+# ── Buffered ingest ──────────────────────────────────────────────────
+# Sensor posts no longer block on WAL fsync: readings land in a bounded
+# in-memory queue and a daemon thread coalesces them — across all
+# concurrent callers — into one COPY per flush window. A full queue
+# surfaces as backpressure (503) at the route.
+_ingest_queue = queue.Queue(maxsize=100_000)
+_ingest_flusher_started = False
+_ingest_flusher_lock = threading.Lock()
+_INGEST_FLUSH_INTERVAL = 0.25   # seconds
+_INGEST_FLUSH_BATCH    = 5000   # rows per COPY
+
+
+def _ingest_flusher(app):
+    while True:
+        batch = [_ingest_queue.get()]
+        deadline = time.monotonic() + _INGEST_FLUSH_INTERVAL
+        while len(batch) < _INGEST_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_ingest_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        with app.app_context():
+            try:
+                IoTService._write_readings(batch)
+                db.session.commit()
+            except Exception as e:
+                logger.warning(f"Sensor ingest flush failed ({len(batch)} rows): {e}")
+                db.session.rollback()
+
+
+def _start_ingest_flusher():
+    global _ingest_flusher_started
+    if not _ingest_flusher_started:
+        with _ingest_flusher_lock:
+            if not _ingest_flusher_started:
+                threading.Thread(
+                    target=_ingest_flusher,
+                    args=(current_app._get_current_object(),),
+                    daemon=True, name='iot-ingest-flusher').start()
+                _ingest_flusher_started = True
+
+# UI polling loops hit the maintenance/risk reads every few seconds
+# while the backing rows change on the scale of minutes. Results are
+# held for a short TTL keyed by (query, factory_id, ...); writes that
+# change the data drop the factory's entries.
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+_READ_CACHE_TTL = 60.0
+
+
+def _cache_get(key):
+    with _read_cache_lock:
+        hit = _read_cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+    return None
+
+
+def _cache_put(key, value):
+    with _read_cache_lock:
+        _read_cache[key] = (time.monotonic() + _READ_CACHE_TTL, value)
+    return value
+
+
+def _cache_invalidate(factory_id):
+    with _read_cache_lock:
+        for key in [k for k in _read_cache if k[1] == factory_id]:
+            del _read_cache[key]
+
 
 class IoTService:
 
@@ -20,60 +99,139 @@ class IoTService:
         Bulk ingest sensor readings.
         readings = [{"metric_name": str, "metric_value": float, "unit": str}]
         """
-        inserted = 0
+        if not readings:
+            return {"queued": 0}
+
+        _start_ingest_flusher()
+        recorded_at = datetime.utcnow().isoformat()
         for r in readings:
+            # Raises queue.Full to the route for a 503 when the flusher
+            # can't keep up
+            _ingest_queue.put_nowait(
+                (device_id, r["metric_name"], r["metric_value"],
+                 r.get("unit", ""), factory_id, recorded_at))
+        return {"queued": len(readings)}
+
+    @staticmethod
+    def _write_readings(rows: list) -> None:
+        """Write (device, metric, value, unit, factory, ts) tuples in one batch.
+
+        One COPY stream instead of one INSERT round-trip per reading —
+        the standard Postgres bulk-ingest path, no per-row parse/plan.
+        """
+        cursor = db.session.connection().connection.cursor()
+        if hasattr(cursor, "copy_expert"):
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerows(rows)
+            buf.seek(0)
+            cursor.copy_expert("""
+                COPY sensor_data (device_id, metric_name, metric_value, unit, factory_id, recorded_at)
+                FROM STDIN WITH (FORMAT csv)
+            """, buf)
+        else:
+            # Non-psycopg2 driver: still one executemany batch, not a
+            # Python loop of single-row INSERTs
             db.session.execute(text("""
                 INSERT INTO sensor_data (device_id, metric_name, metric_value, unit, factory_id, recorded_at)
-                VALUES (:did, :name, :val, :unit, :fid, NOW())
-            """), {
-                "did": device_id, "name": r["metric_name"],
-                "val": r["metric_value"], "unit": r.get("unit", ""),
-                "fid": factory_id
-            })
-            inserted += 1
-        db.session.commit()
-        return {"inserted": inserted}
+                VALUES (:did, :name, :val, :unit, :fid, :ts)
+            """), [
+                {"did": did, "name": name, "val": val,
+                 "unit": unit, "fid": fid, "ts": ts}
+                for did, name, val, unit, fid, ts in rows
+            ])
 
     @staticmethod
     def get_sensor_summary(factory_id: int, hours: int = 1) -> list:
         """Latest sensor reading per device/metric."""
+        # DISTINCT ON walks the (device_id, metric_name, recorded_at
+        # DESC) index once instead of one LATERAL probe per device, and
+        # returns the latest reading per metric rather than per device
         sql = """
-            SELECT
-                d.id AS device_id, d.name AS device_name, d.device_type,
-                m.code AS machine_code, m.name AS machine_name,
-                sd.metric_name, sd.metric_value, sd.unit, sd.recorded_at, sd.quality_flag
-            FROM iot_devices d
-            JOIN machines m ON m.id = d.machine_id
-            JOIN LATERAL (
-                SELECT metric_name, metric_value, unit, recorded_at, quality_flag
-                FROM sensor_data
-                WHERE device_id = d.id AND factory_id = :fid
-                  AND recorded_at >= NOW() - (:hours * INTERVAL '1 hour')
-                ORDER BY recorded_at DESC
-                LIMIT 1
-            ) sd ON TRUE
-            WHERE d.factory_id = :fid AND d.deleted_at IS NULL AND d.is_active = TRUE
-            ORDER BY d.machine_id, d.device_type
+            SELECT s.device_id, s.device_name, s.device_type,
+                   s.machine_code, s.machine_name,
+                   s.metric_name, s.metric_value, s.unit, s.recorded_at, s.quality_flag
+            FROM (
+                SELECT DISTINCT ON (sd.device_id, sd.metric_name)
+                    d.id AS device_id, d.name AS device_name, d.device_type,
+                    d.machine_id,
+                    m.code AS machine_code, m.name AS machine_name,
+                    sd.metric_name, sd.metric_value, sd.unit, sd.recorded_at, sd.quality_flag
+                FROM sensor_data sd
+                JOIN iot_devices d ON d.id = sd.device_id
+                JOIN machines m ON m.id = d.machine_id
+                WHERE sd.factory_id = :fid
+                  AND sd.recorded_at >= NOW() - (:hours * INTERVAL '1 hour')
+                  AND d.factory_id = :fid AND d.deleted_at IS NULL AND d.is_active = TRUE
+                ORDER BY sd.device_id, sd.metric_name, sd.recorded_at DESC
+            ) s
+            ORDER BY s.machine_id, s.device_type
         """
-        rows = db.session.execute(text(sql), {"fid": factory_id, "hours": hours}).fetchall()
-        return [dict(r._mapping) for r in rows]
+        # RowMapping serializes through jsonify directly — no per-row
+        # dict() boxing needed
+        return db.session.execute(text(sql), {"fid": factory_id, "hours": hours}).mappings().all()
 
     @staticmethod
     def get_sensor_timeseries(factory_id: int, device_id: int,
                               metric: str, hours: int = 24) -> list:
+        # Postgres builds the JSON array; Python receives one value
+        # instead of constructing up to 1000 row dicts
         sql = """
-            SELECT metric_value, unit, recorded_at, quality_flag
-            FROM sensor_data
-            WHERE factory_id = :fid AND device_id = :did AND metric_name = :metric
-              AND recorded_at >= NOW() - (:hours * INTERVAL '1 hour')
-            ORDER BY recorded_at ASC
-            LIMIT 1000
+            SELECT COALESCE(json_agg(json_build_object(
+                       'metric_value', metric_value,
+                       'unit', unit,
+                       'recorded_at', recorded_at,
+                       'quality_flag', quality_flag
+                   ) ORDER BY recorded_at), '[]'::json)
+            FROM (
+                SELECT metric_value, unit, recorded_at, quality_flag
+                FROM sensor_data
+                WHERE factory_id = :fid AND device_id = :did AND metric_name = :metric
+                  AND recorded_at >= NOW() - (:hours * INTERVAL '1 hour')
+                ORDER BY recorded_at ASC
+                LIMIT 1000
+            ) t
         """
-        rows = db.session.execute(text(sql), {
+        return db.session.execute(text(sql), {
             "fid": factory_id, "did": device_id,
             "metric": metric, "hours": hours
-        }).fetchall()
-        return [dict(r._mapping) for r in rows]
+        }).scalar()
+
+    @staticmethod
+    def stream_sensor_readings(factory_id: int, device_id: Optional[int] = None,
+                               metric: Optional[str] = None, hours: int = 24):
+        """Yield CSV lines for raw readings over a server-side cursor.
+
+        Exports are unbounded, so the result streams in 500-row batches
+        (stream_results) instead of being fetched — and serialized —
+        in one piece.
+        """
+        sql = text("""
+            SELECT device_id, metric_name, metric_value, unit, quality_flag, recorded_at
+            FROM sensor_data
+            WHERE factory_id = :fid
+              AND (CAST(:did AS integer) IS NULL OR device_id = :did)
+              AND (CAST(:metric AS varchar) IS NULL OR metric_name = :metric)
+              AND recorded_at >= NOW() - (:hours * INTERVAL '1 hour')
+            ORDER BY recorded_at ASC
+        """)
+        result = db.session.execute(
+            sql,
+            {"fid": factory_id, "did": device_id, "metric": metric, "hours": hours},
+            execution_options={"stream_results": True, "yield_per": 500},
+        )
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["device_id", "metric_name", "metric_value",
+                         "unit", "quality_flag", "recorded_at"])
+        for row in result:
+            writer.writerow([row.device_id, row.metric_name, row.metric_value,
+                             row.unit, row.quality_flag, row.recorded_at])
+            if buf.tell() > 64 * 1024:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
 
     @staticmethod
     def get_devices(factory_id: int, machine_id: Optional[int] = None) -> list:
@@ -91,8 +249,7 @@ class IoTService:
             WHERE {where}
             ORDER BY d.machine_id, d.name
         """
-        rows = db.session.execute(text(sql), params).fetchall()
-        return [dict(r._mapping) for r in rows]
+        return db.session.execute(text(sql), params).mappings().all()
 
     @staticmethod
     def create_device(factory_id: int, data: dict) -> dict:
@@ -107,26 +264,34 @@ class IoTService:
             "fid": factory_id
         }).fetchone()
         db.session.commit()
+        _cache_invalidate(factory_id)
         return dict(row._mapping)
 
 
 class MaintenanceService:
 
     @staticmethod
-    def calculate_mtbf(factory_id: int, machine_id: int) -> dict:
-        """
-        MTBF = Total Operating Time / Number of Failures
-        """
+    def _mtbf_aggregate(factory_id: int, machine_id: int):
+        """One aggregate scan with everything MTBF and the failure
+        predictor need, so predict_failure avoids a second round trip."""
         sql = """
             SELECT
                 COUNT(*) FILTER (WHERE event_type = 'unplanned') AS failures,
                 SUM(duration_hours) FILTER (WHERE event_type = 'unplanned') AS total_downtime,
                 MIN(started_at) AS first_event,
-                MAX(COALESCE(ended_at, NOW())) AS last_event
+                MAX(COALESCE(ended_at, NOW())) AS last_event,
+                MAX(ended_at) AS last_maintenance
             FROM maintenance_events
             WHERE factory_id = :fid AND machine_id = :mid
         """
-        row = db.session.execute(text(sql), {"fid": factory_id, "mid": machine_id}).fetchone()
+        return db.session.execute(text(sql), {"fid": factory_id, "mid": machine_id}).fetchone()
+
+    @staticmethod
+    def calculate_mtbf(factory_id: int, machine_id: int, _row=None) -> dict:
+        """
+        MTBF = Total Operating Time / Number of Failures
+        """
+        row = _row if _row is not None else MaintenanceService._mtbf_aggregate(factory_id, machine_id)
 
         failures = int(row.failures or 0)
         if failures == 0:
@@ -155,15 +320,16 @@ class MaintenanceService:
         """
         Simple failure prediction based on MTBF + last maintenance.
         """
-        mtbf_data = MaintenanceService.calculate_mtbf(factory_id, machine_id)
+        cached = _cache_get(("predict", factory_id, machine_id))
+        if cached is not None:
+            return cached
 
-        last_event = db.session.execute(text("""
-            SELECT MAX(ended_at) AS last_maintenance
-            FROM maintenance_events
-            WHERE factory_id = :fid AND machine_id = :mid
-        """), {"fid": factory_id, "mid": machine_id}).fetchone()
+        # One aggregate carries both the MTBF inputs and the last
+        # maintenance timestamp — the old shape ran two serial queries
+        row = MaintenanceService._mtbf_aggregate(factory_id, machine_id)
+        mtbf_data = MaintenanceService.calculate_mtbf(factory_id, machine_id, _row=row)
 
-        last_maintenance = last_event.last_maintenance if last_event else None
+        last_maintenance = row.last_maintenance
         mtbf = mtbf_data.get("mtbf_hours")
 
         if not mtbf or not last_maintenance:
@@ -179,14 +345,73 @@ class MaintenanceService:
 
         risk_level = "critical" if confidence < 0.3 else "high" if confidence < 0.5 else "medium" if confidence < 0.7 else "low"
 
-        return {
+        return _cache_put(("predict", factory_id, machine_id), {
             "machine_id": machine_id,
             "predicted_failure_date": predicted_date.strftime("%Y-%m-%d"),
             "confidence_score": round(confidence, 4),
             "risk_level": risk_level,
             "mtbf_hours": mtbf,
             "recommended_action": MaintenanceService._maintenance_recommendation(risk_level),
-        }
+        })
+
+    @staticmethod
+    def predict_failures_bulk(factory_id: int) -> list:
+        """Failure predictions for every machine in the factory.
+
+        One grouped scan fetches each machine's MTBF inputs; the
+        per-machine arithmetic runs as NumPy array ops instead of a
+        Python loop of predict_failure calls (one query per machine).
+        """
+        rows = db.session.execute(text("""
+            SELECT m.id AS machine_id, m.code AS machine_code,
+                   COUNT(*) FILTER (WHERE me.event_type = 'unplanned') AS failures,
+                   SUM(me.duration_hours) FILTER (WHERE me.event_type = 'unplanned') AS total_downtime,
+                   MIN(me.started_at) AS first_event,
+                   MAX(COALESCE(me.ended_at, NOW())) AS last_event,
+                   MAX(me.ended_at) AS last_maintenance
+            FROM machines m
+            LEFT JOIN maintenance_events me
+                   ON me.machine_id = m.id AND me.factory_id = m.factory_id
+            WHERE m.factory_id = :fid AND m.deleted_at IS NULL
+            GROUP BY m.id, m.code
+            ORDER BY m.code
+        """), {"fid": factory_id}).fetchall()
+        if not rows:
+            return []
+
+        now = datetime.now()
+        n = len(rows)
+        mtbf = np.zeros(n)
+        hours_since = np.zeros(n)
+        known = np.zeros(n, dtype=bool)
+        for i, r in enumerate(rows):
+            failures = int(r.failures or 0)
+            if failures and r.first_event and r.last_event and r.last_maintenance:
+                total = (r.last_event - r.first_event).total_seconds() / 3600
+                operating = max(0, total - float(r.total_downtime or 0))
+                if operating:
+                    mtbf[i] = operating / failures
+                    hours_since[i] = (now - r.last_maintenance).total_seconds() / 3600
+                    known[i] = True
+
+        safe_mtbf = np.where(known, mtbf, 1.0)
+        remaining = np.where(known, np.maximum(0, mtbf - hours_since), 30 * 24)
+        confidence = np.where(known,
+                              np.clip(1 - hours_since / safe_mtbf, 0.1, 0.95),
+                              0.35)
+        levels = np.select(
+            [confidence < 0.3, confidence < 0.5, confidence < 0.7],
+            ["critical", "high", "medium"], default="low")
+
+        return [{
+            "machine_id": r.machine_id,
+            "machine_code": r.machine_code,
+            "predicted_failure_date": (now + timedelta(hours=float(remaining[i]))).strftime("%Y-%m-%d"),
+            "confidence_score": round(float(confidence[i]), 4),
+            "risk_level": str(levels[i]),
+            "mtbf_hours": round(float(mtbf[i]), 2) if known[i] else None,
+            "recommended_action": MaintenanceService._maintenance_recommendation(str(levels[i])),
+        } for i, r in enumerate(rows)]
 
     @staticmethod
     def _maintenance_recommendation(risk_level: str) -> str:
@@ -199,6 +424,9 @@ class MaintenanceService:
 
     @staticmethod
     def get_maintenance_schedule(factory_id: int) -> list:
+        cached = _cache_get(("schedule", factory_id))
+        if cached is not None:
+            return cached
         sql = """
             SELECT
                 mp.id, mp.predicted_failure_date, mp.confidence_score, mp.risk_level,
@@ -210,11 +438,14 @@ class MaintenanceService:
             ORDER BY mp.risk_level DESC, mp.predicted_failure_date ASC
             LIMIT 20
         """
-        rows = db.session.execute(text(sql), {"fid": factory_id}).fetchall()
-        return [dict(r._mapping) for r in rows]
+        rows = db.session.execute(text(sql), {"fid": factory_id}).mappings().all()
+        return _cache_put(("schedule", factory_id), rows)
 
     @staticmethod
     def get_risk_scores(factory_id: int) -> list:
+        cached = _cache_get(("risk_scores", factory_id))
+        if cached is not None:
+            return cached
         sql = """
             SELECT
                 rs.id, rs.risk_level, rs.probability_score, rs.predicted_defect_type,
@@ -226,42 +457,34 @@ class MaintenanceService:
               AND (rs.expires_at IS NULL OR rs.expires_at > NOW())
             ORDER BY rs.probability_score DESC
         """
-        rows = db.session.execute(text(sql), {"fid": factory_id}).fetchall()
-        return [dict(r._mapping) for r in rows]
+        rows = db.session.execute(text(sql), {"fid": factory_id}).mappings().all()
+        return _cache_put(("risk_scores", factory_id), rows)
 
     @staticmethod
     def generate_risk_scores(factory_id: int) -> list:
         """Generate risk scores for all machines based on recent defect patterns."""
+        # One grouped scan covers every machine's 7-day defect rate —
+        # the old shape was one SELECT plus one INSERT per machine
         machines = db.session.execute(text("""
-            SELECT id, code, name FROM machines
-            WHERE factory_id = :fid AND deleted_at IS NULL
+            SELECT m.id, m.code, m.name,
+                   COALESCE(SUM(dr.quantity_defective)::FLOAT
+                            / NULLIF(SUM(dr.quantity_produced), 0), 0) AS dr,
+                   COUNT(dr.id) AS events
+            FROM machines m
+            LEFT JOIN defect_records dr
+                   ON dr.machine_id = m.id AND dr.factory_id = m.factory_id
+                  AND dr.defect_date >= CURRENT_DATE - INTERVAL '7 days'
+                  AND dr.deleted_at IS NULL
+            WHERE m.factory_id = :fid AND m.deleted_at IS NULL
+            GROUP BY m.id, m.code, m.name
         """), {"fid": factory_id}).fetchall()
 
         scores = []
+        upsert_params = []
         for m in machines:
-            defect_rate = db.session.execute(text("""
-                SELECT
-                    COALESCE(SUM(quantity_defective)::FLOAT / NULLIF(SUM(quantity_produced),0), 0) AS dr,
-                    COUNT(*) AS events
-                FROM defect_records
-                WHERE machine_id = :mid AND factory_id = :fid
-                  AND defect_date >= CURRENT_DATE - INTERVAL '7 days'
-                  AND deleted_at IS NULL
-            """), {"mid": m.id, "fid": factory_id}).fetchone()
-
-            dr = float(defect_rate.dr or 0)
-            events = int(defect_rate.events or 0)
-            prob = min(0.99, dr * 5 + events * 0.02)
+            prob = min(0.99, float(m.dr or 0) * 5 + int(m.events or 0) * 0.02)
             level = "critical" if prob > 0.7 else "high" if prob > 0.4 else "medium" if prob > 0.2 else "low"
-
-            # Upsert risk score
-            db.session.execute(text("""
-                INSERT INTO risk_scores
-                    (machine_id, risk_level, probability_score, predicted_defect_type,
-                     recommendation, generated_at, expires_at, factory_id)
-                VALUES (:mid, :level, :prob, :deftype, :rec, NOW(), NOW() + INTERVAL '24 hours', :fid)
-                ON CONFLICT DO NOTHING
-            """), {
+            upsert_params.append({
                 "mid": m.id, "level": level, "prob": round(prob, 4),
                 "deftype": "Surface/Dimensional" if prob > 0.3 else "Normal variation",
                 "rec": MaintenanceService._maintenance_recommendation(level),
@@ -272,5 +495,25 @@ class MaintenanceService:
                 "risk_level": level, "probability_score": round(prob, 4)
             })
 
+        if upsert_params:
+            # Real upsert against the one-active-score-per-machine
+            # partial unique index: refreshes in place instead of
+            # appending (or silently dropping) a row per run
+            db.session.execute(text("""
+                INSERT INTO risk_scores
+                    (machine_id, risk_level, probability_score, predicted_defect_type,
+                     recommendation, generated_at, expires_at, factory_id)
+                VALUES (:mid, :level, :prob, :deftype, :rec, NOW(), NOW() + INTERVAL '24 hours', :fid)
+                ON CONFLICT (machine_id, factory_id) WHERE is_active = TRUE
+                DO UPDATE SET
+                    risk_level = EXCLUDED.risk_level,
+                    probability_score = EXCLUDED.probability_score,
+                    predicted_defect_type = EXCLUDED.predicted_defect_type,
+                    recommendation = EXCLUDED.recommendation,
+                    generated_at = NOW(),
+                    expires_at = NOW() + INTERVAL '24 hours'
+            """), upsert_params)
+
         db.session.commit()
+        _cache_invalidate(factory_id)
         return scores
@@ -4,48 +4,231 @@ Computes PPM, Defect Rate, First Pass Yield, OEE, Trends, and Distribution
 """
 from datetime import datetime, timedelta
 from typing import Optional
+from flask import g, has_request_context
 from models import db
 from sqlalchemy import text
 import logging
 
 logger = logging.getLogger(__name__)
 
+# The whole dashboard payload in one statement: the date-filtered base
+# sets are materialized once as CTEs and every metric derives from
+# them, instead of seven service calls each rescanning the same rows.
+# NULL-tolerant date predicates keep one plan for all filter combos.
+_SQL_COMPREHENSIVE = text("""
+    WITH dr_base AS (
+        SELECT defect_date, shift, machine_id, defect_code_id,
+               quantity_defective, quantity_produced, id
+        FROM defect_records dr
+        WHERE dr.factory_id = :factory_id AND dr.deleted_at IS NULL
+          AND (CAST(:start_date AS date) IS NULL OR dr.defect_date >= :start_date)
+          AND (CAST(:end_date AS date) IS NULL OR dr.defect_date <= :end_date)
+    ),
+    pr_base AS (
+        SELECT id, actual_time_minutes, downtime_minutes,
+               planned_quantity, actual_quantity
+        FROM production_records pr
+        WHERE pr.factory_id = :factory_id AND pr.deleted_at IS NULL
+          AND (CAST(:start_date AS date) IS NULL OR pr.production_date >= :start_date)
+          AND (CAST(:end_date AS date) IS NULL OR pr.production_date <= :end_date)
+    ),
+    dr_totals AS (
+        SELECT COALESCE(SUM(quantity_defective), 0) AS total_defective,
+               COALESCE(SUM(quantity_produced), 0)  AS total_produced
+        FROM dr_base
+    ),
+    pr_totals AS (
+        SELECT COALESCE(SUM(pr.actual_time_minutes), 0) AS total_time,
+               COALESCE(SUM(pr.downtime_minutes), 0)    AS total_downtime,
+               COALESCE(SUM(pr.planned_quantity), 0)    AS total_planned,
+               COALESCE(SUM(pr.actual_quantity), 0)     AS total_actual,
+               COALESCE(SUM(d.defective_sum), 0)        AS total_defective
+        FROM pr_base pr
+        LEFT JOIN LATERAL (
+            SELECT SUM(quantity_defective) AS defective_sum
+            FROM defect_records d
+            WHERE d.production_record_id = pr.id AND d.deleted_at IS NULL
+        ) d ON TRUE
+    ),
+    trend AS (
+        SELECT DATE_TRUNC('day', defect_date::TIMESTAMP)::DATE AS period,
+               SUM(quantity_defective) AS total_defective,
+               SUM(quantity_produced)  AS total_produced,
+               CASE WHEN SUM(quantity_produced) > 0
+                    THEN ROUND(SUM(quantity_defective)::NUMERIC / SUM(quantity_produced) * 1000000, 2)
+                    ELSE 0 END AS ppm,
+               CASE WHEN SUM(quantity_produced) > 0
+                    THEN ROUND(SUM(quantity_defective)::NUMERIC / SUM(quantity_produced) * 100, 4)
+                    ELSE 0 END AS defect_rate
+        FROM defect_records
+        WHERE factory_id = :factory_id AND deleted_at IS NULL
+          AND defect_date BETWEEN CURRENT_DATE - INTERVAL '30 days' AND CURRENT_DATE
+        GROUP BY 1
+    ),
+    pareto AS (
+        SELECT dc.code, dc.description, cat.name AS category, cat.severity_level,
+               SUM(dr.quantity_defective) AS total_defective,
+               COUNT(dr.id) AS occurrence_count
+        FROM dr_base dr
+        JOIN defect_codes dc ON dc.id = dr.defect_code_id
+        LEFT JOIN defect_categories cat ON cat.id = dc.category_id
+        GROUP BY dc.code, dc.description, cat.name, cat.severity_level
+        ORDER BY total_defective DESC
+        LIMIT 10
+    ),
+    heatmap AS (
+        SELECT m.code AS machine_code, m.name AS machine_name, dr.shift,
+               SUM(dr.quantity_defective) AS total_defective,
+               CASE WHEN SUM(dr.quantity_produced) > 0
+                    THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
+                    ELSE 0 END AS ppm
+        FROM dr_base dr
+        JOIN machines m ON m.id = dr.machine_id
+        GROUP BY m.code, m.name, dr.shift
+    )
+    SELECT
+        (SELECT row_to_json(t) FROM dr_totals t) AS dr_totals,
+        (SELECT row_to_json(t) FROM pr_totals t) AS pr_totals,
+        (SELECT COALESCE(json_agg(t ORDER BY t.period), '[]'::json) FROM trend t) AS trend,
+        (SELECT COALESCE(json_agg(t ORDER BY t.total_defective DESC), '[]'::json) FROM pareto t) AS pareto,
+        (SELECT COALESCE(json_agg(t ORDER BY t.total_defective DESC), '[]'::json) FROM heatmap t) AS heatmap
+""")
+
+
+# Fixed-shape statements with NULL-tolerant optional filters: every
+# filter combination runs the same SQL text, so the server caches one
+# plan instead of re-parsing a fresh WHERE variant per request.
+# PPM reads the mv_factory_quality rollup (per factory/machine/day)
+# instead of raw defect_records — a few rollup rows per request, with
+# the raw scan paid once per refresh_rollups() across all dashboards
+_SQL_PPM = text("""
+    SELECT
+        SUM(d) AS total_defective,
+        SUM(p) AS total_produced,
+        CASE
+            WHEN SUM(p) > 0
+            THEN ROUND(SUM(d)::NUMERIC / SUM(p) * 1000000, 2)
+            ELSE 0
+        END AS ppm
+    FROM mv_factory_quality
+    WHERE factory_id = :factory_id
+      AND (CAST(:start_date AS date) IS NULL OR day >= :start_date)
+      AND (CAST(:end_date AS date) IS NULL OR day <= :end_date)
+      AND (CAST(:machine_id AS integer) IS NULL OR machine_id = :machine_id)
+""")
+
+# The defect sums are correlated LATERAL probes rather than an
+# uncorrelated GROUP BY over every defect record: the planner only
+# touches defects belonging to the production rows the date filter
+# selected, instead of hashing the whole table first
+_SQL_FPY = text("""
+    SELECT
+        SUM(pr.actual_quantity) AS total_produced,
+        COALESCE(SUM(dr.defective_sum), 0) AS total_defective
+    FROM production_records pr
+    LEFT JOIN LATERAL (
+        SELECT SUM(quantity_defective) AS defective_sum
+        FROM defect_records d
+        WHERE d.production_record_id = pr.id AND d.deleted_at IS NULL
+    ) dr ON TRUE
+    WHERE pr.factory_id = :factory_id AND pr.deleted_at IS NULL
+      AND (CAST(:start_date AS date) IS NULL OR pr.production_date >= :start_date)
+      AND (CAST(:end_date AS date) IS NULL OR pr.production_date <= :end_date)
+""")
+
+_SQL_OEE = text("""
+    SELECT
+        SUM(pr.actual_time_minutes) AS total_time,
+        SUM(pr.downtime_minutes) AS total_downtime,
+        SUM(pr.planned_quantity) AS total_planned,
+        SUM(pr.actual_quantity) AS total_actual,
+        COALESCE(SUM(dr.defective_sum), 0) AS total_defective
+    FROM production_records pr
+    LEFT JOIN LATERAL (
+        SELECT SUM(quantity_defective) AS defective_sum
+        FROM defect_records d
+        WHERE d.production_record_id = pr.id AND d.deleted_at IS NULL
+    ) dr ON TRUE
+    WHERE pr.factory_id = :factory_id AND pr.deleted_at IS NULL
+      AND (CAST(:start_date AS date) IS NULL OR pr.production_date >= :start_date)
+      AND (CAST(:end_date AS date) IS NULL OR pr.production_date <= :end_date)
+      AND (CAST(:machine_id AS integer) IS NULL OR pr.machine_id = :machine_id)
+""")
+
+# Percentage and cumulative share are window functions over the full
+# grouped set, so they are correct even when LIMIT clips the tail (the
+# old Python loop totalled only the returned rows)
+_SQL_PARETO = text("""
+    WITH agg AS (
+        SELECT
+            dc.code,
+            dc.description,
+            cat.name AS category,
+            cat.severity_level,
+            SUM(dr.quantity_defective) AS total_defective,
+            COUNT(dr.id) AS occurrence_count
+        FROM defect_records dr
+        JOIN defect_codes dc ON dc.id = dr.defect_code_id
+        LEFT JOIN defect_categories cat ON cat.id = dc.category_id
+        WHERE dr.factory_id = :factory_id AND dr.deleted_at IS NULL
+          AND (CAST(:start_date AS date) IS NULL OR dr.defect_date >= :start_date)
+          AND (CAST(:end_date AS date) IS NULL OR dr.defect_date <= :end_date)
+        GROUP BY dc.code, dc.description, cat.name, cat.severity_level
+    )
+    SELECT code, description, category, severity_level,
+           total_defective, occurrence_count,
+           ROUND(total_defective::NUMERIC
+                 / NULLIF(SUM(total_defective) OVER (), 0) * 100, 2) AS percentage,
+           ROUND(SUM(total_defective) OVER (ORDER BY total_defective DESC
+                                            ROWS UNBOUNDED PRECEDING)::NUMERIC
+                 / NULLIF(SUM(total_defective) OVER (), 0) * 100, 2) AS cumulative_pct
+    FROM agg
+    ORDER BY total_defective DESC
+    LIMIT :limit
+""")
+
+_SQL_HEATMAP = text("""
+    SELECT
+        m.code AS machine_code,
+        m.name AS machine_name,
+        dr.shift,
+        SUM(dr.quantity_defective) AS total_defective,
+        CASE
+            WHEN SUM(dr.quantity_produced) > 0
+            THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
+            ELSE 0
+        END AS ppm
+    FROM defect_records dr
+    JOIN machines m ON m.id = dr.machine_id
+    WHERE dr.factory_id = :factory_id AND dr.deleted_at IS NULL
+      AND (CAST(:start_date AS date) IS NULL OR dr.defect_date >= :start_date)
+      AND (CAST(:end_date AS date) IS NULL OR dr.defect_date <= :end_date)
+    GROUP BY m.code, m.name, dr.shift
+    ORDER BY total_defective DESC
+""")
+
 
 class QualityMetricsService:
 
+    @staticmethod
+    def refresh_rollups():
+        """Refresh the PPM rollup (call from a scheduler, e.g. every 60s)."""
+        db.session.execute(text(
+            "REFRESH MATERIALIZED VIEW CONCURRENTLY mv_factory_quality"))
+        db.session.commit()
+
     @staticmethod
     def calculate_ppm(factory_id: int, start_date=None, end_date=None,
                       machine_id: Optional[int] = None) -> dict:
         """
         PPM = (Total Defective / Total Produced) * 1,000,000
         """
-        filters = ["dr.factory_id = :factory_id", "dr.deleted_at IS NULL"]
-        params = {"factory_id": factory_id}
-
-        if start_date:
-            filters.append("dr.defect_date >= :start_date")
-            params["start_date"] = start_date
-        if end_date:
-            filters.append("dr.defect_date <= :end_date")
-            params["end_date"] = end_date
-        if machine_id:
-            filters.append("dr.machine_id = :machine_id")
-            params["machine_id"] = machine_id
-
-        where = " AND ".join(filters)
-        sql = f"""
-            SELECT
-                SUM(dr.quantity_defective) AS total_defective,
-                SUM(dr.quantity_produced) AS total_produced,
-                CASE
-                    WHEN SUM(dr.quantity_produced) > 0
-                    THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
-                    ELSE 0
-                END AS ppm
-            FROM defect_records dr
-            WHERE {where}
-        """
-        result = db.session.execute(text(sql), params).fetchone()
+        result = db.session.execute(_SQL_PPM, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "machine_id": machine_id,
+        }).fetchone()
         return {
             "ppm": float(result.ppm or 0),
             "total_defective": int(result.total_defective or 0),
@@ -57,6 +240,8 @@ class QualityMetricsService:
                               machine_id: Optional[int] = None) -> dict:
         """
         Defect Rate % = (Total Defective / Total Produced) * 100
+
+        Derived from the PPM aggregate's totals — no SQL of its own.
         """
         ppm_data = QualityMetricsService.calculate_ppm(
             factory_id, start_date, end_date, machine_id)
@@ -74,30 +259,11 @@ class QualityMetricsService:
         """
         FPY = (Total Produced - Total Defective) / Total Produced * 100
         """
-        filters = ["pr.factory_id = :factory_id", "pr.deleted_at IS NULL"]
-        params = {"factory_id": factory_id}
-        if start_date:
-            filters.append("pr.production_date >= :start_date")
-            params["start_date"] = start_date
-        if end_date:
-            filters.append("pr.production_date <= :end_date")
-            params["end_date"] = end_date
-
-        where = " AND ".join(filters)
-        sql = f"""
-            SELECT
-                SUM(pr.actual_quantity) AS total_produced,
-                COALESCE(SUM(dr.defective_sum), 0) AS total_defective
-            FROM production_records pr
-            LEFT JOIN (
-                SELECT production_record_id, SUM(quantity_defective) AS defective_sum
-                FROM defect_records
-                WHERE deleted_at IS NULL
-                GROUP BY production_record_id
-            ) dr ON dr.production_record_id = pr.id
-            WHERE {where}
-        """
-        result = db.session.execute(text(sql), params).fetchone()
+        result = db.session.execute(_SQL_FPY, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+        }).fetchone()
         total_produced = int(result.total_produced or 0)
         total_defective = int(result.total_defective or 0)
         good = total_produced - total_defective
@@ -118,35 +284,12 @@ class QualityMetricsService:
         Performance = Actual Quantity / Planned Quantity
         Quality = Good Units / Actual Quantity
         """
-        filters = ["pr.factory_id = :factory_id", "pr.deleted_at IS NULL"]
-        params = {"factory_id": factory_id}
-        if start_date:
-            filters.append("pr.production_date >= :start_date")
-            params["start_date"] = start_date
-        if end_date:
-            filters.append("pr.production_date <= :end_date")
-            params["end_date"] = end_date
-        if machine_id:
-            filters.append("pr.machine_id = :machine_id")
-            params["machine_id"] = machine_id
-
-        where = " AND ".join(filters)
-        sql = f"""
-            SELECT
-                SUM(pr.actual_time_minutes) AS total_time,
-                SUM(pr.downtime_minutes) AS total_downtime,
-                SUM(pr.planned_quantity) AS total_planned,
-                SUM(pr.actual_quantity) AS total_actual,
-                COALESCE(SUM(dr.defective_sum), 0) AS total_defective
-            FROM production_records pr
-            LEFT JOIN (
-                SELECT production_record_id, SUM(quantity_defective) AS defective_sum
-                FROM defect_records WHERE deleted_at IS NULL
-                GROUP BY production_record_id
-            ) dr ON dr.production_record_id = pr.id
-            WHERE {where}
-        """
-        row = db.session.execute(text(sql), params).fetchone()
+        row = db.session.execute(_SQL_OEE, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "machine_id": machine_id,
+        }).fetchone()
 
         total_time = float(row.total_time or 0)
         total_downtime = float(row.total_downtime or 0)
@@ -182,37 +325,57 @@ class QualityMetricsService:
         start_date = end_date - timedelta(days=days)
 
         if period == "daily":
-            trunc = "day"
+            trunc, step = "day", "1 day"
         elif period == "weekly":
-            trunc = "week"
+            trunc, step = "week", "1 week"
         else:
-            trunc = "month"
+            trunc, step = "month", "1 month"
 
+        # generate_series emits every period in range so gaps come back
+        # as zero rows instead of missing points; charts previously
+        # drew a straight line across days with no defect records
         sql = """
-            SELECT
-                DATE_TRUNC(:trunc, dr.defect_date::TIMESTAMP)::DATE AS period_start,
-                SUM(dr.quantity_defective) AS total_defective,
-                SUM(dr.quantity_produced) AS total_produced,
-                CASE
-                    WHEN SUM(dr.quantity_produced) > 0
-                    THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
-                    ELSE 0
-                END AS ppm,
-                CASE
-                    WHEN SUM(dr.quantity_produced) > 0
-                    THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 100, 4)
-                    ELSE 0
-                END AS defect_rate
-            FROM defect_records dr
-            WHERE dr.factory_id = :factory_id
-              AND dr.deleted_at IS NULL
-              AND dr.defect_date BETWEEN :start_date AND :end_date
-            GROUP BY 1
-            ORDER BY 1
+            WITH periods AS (
+                SELECT generate_series(
+                    DATE_TRUNC(:trunc, CAST(:start_date AS timestamp)),
+                    DATE_TRUNC(:trunc, CAST(:end_date AS timestamp)),
+                    CAST(:step AS interval)
+                )::DATE AS period_start
+            ),
+            agg AS (
+                SELECT
+                    DATE_TRUNC(:trunc, dr.defect_date::TIMESTAMP)::DATE AS period_start,
+                    SUM(dr.quantity_defective) AS total_defective,
+                    SUM(dr.quantity_produced) AS total_produced,
+                    CASE
+                        WHEN SUM(dr.quantity_produced) > 0
+                        THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
+                        ELSE 0
+                    END AS ppm,
+                    CASE
+                        WHEN SUM(dr.quantity_produced) > 0
+                        THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 100, 4)
+                        ELSE 0
+                    END AS defect_rate
+                FROM defect_records dr
+                WHERE dr.factory_id = :factory_id
+                  AND dr.deleted_at IS NULL
+                  AND dr.defect_date BETWEEN :start_date AND :end_date
+                GROUP BY 1
+            )
+            SELECT p.period_start,
+                   COALESCE(a.total_defective, 0) AS total_defective,
+                   COALESCE(a.total_produced, 0)  AS total_produced,
+                   COALESCE(a.ppm, 0)             AS ppm,
+                   COALESCE(a.defect_rate, 0)     AS defect_rate
+            FROM periods p
+            LEFT JOIN agg a USING (period_start)
+            ORDER BY p.period_start
         """
         rows = db.session.execute(text(sql), {
             "factory_id": factory_id,
             "trunc": trunc,
+            "step": step,
             "start_date": start_date,
             "end_date": end_date,
         }).fetchall()
@@ -234,82 +397,34 @@ class QualityMetricsService:
         """
         Pareto distribution of defects by code/category.
         """
-        filters = ["dr.factory_id = :factory_id", "dr.deleted_at IS NULL"]
-        params = {"factory_id": factory_id, "limit": limit}
-        if start_date:
-            filters.append("dr.defect_date >= :start_date")
-            params["start_date"] = start_date
-        if end_date:
-            filters.append("dr.defect_date <= :end_date")
-            params["end_date"] = end_date
-
-        where = " AND ".join(filters)
-        sql = f"""
-            SELECT
-                dc.code,
-                dc.description,
-                cat.name AS category,
-                cat.severity_level,
-                SUM(dr.quantity_defective) AS total_defective,
-                COUNT(dr.id) AS occurrence_count
-            FROM defect_records dr
-            JOIN defect_codes dc ON dc.id = dr.defect_code_id
-            LEFT JOIN defect_categories cat ON cat.id = dc.category_id
-            WHERE {where}
-            GROUP BY dc.code, dc.description, cat.name, cat.severity_level
-            ORDER BY total_defective DESC
-            LIMIT :limit
-        """
-        rows = db.session.execute(text(sql), params).fetchall()
-        total = sum(int(r.total_defective or 0) for r in rows)
-        result = []
-        cumulative = 0
-        for r in rows:
-            count = int(r.total_defective or 0)
-            cumulative += count
-            result.append({
+        rows = db.session.execute(_SQL_PARETO, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "limit": limit,
+        }).fetchall()
+        return [
+            {
                 "code": r.code,
                 "description": r.description,
                 "category": r.category,
                 "severity_level": r.severity_level,
-                "total_defective": count,
+                "total_defective": int(r.total_defective or 0),
                 "occurrence_count": int(r.occurrence_count),
-                "percentage": round(count / total * 100, 2) if total else 0,
-                "cumulative_pct": round(cumulative / total * 100, 2) if total else 0,
-            })
-        return result
+                "percentage": float(r.percentage or 0),
+                "cumulative_pct": float(r.cumulative_pct or 0),
+            }
+            for r in rows
+        ]
 
     @staticmethod
     def get_machine_heatmap(factory_id: int, start_date=None, end_date=None) -> list:
         """Returns defect counts by machine and shift for heatmap visualization."""
-        filters = ["dr.factory_id = :factory_id", "dr.deleted_at IS NULL"]
-        params = {"factory_id": factory_id}
-        if start_date:
-            filters.append("dr.defect_date >= :start_date")
-            params["start_date"] = start_date
-        if end_date:
-            filters.append("dr.defect_date <= :end_date")
-            params["end_date"] = end_date
-
-        where = " AND ".join(filters)
-        sql = f"""
-            SELECT
-                m.code AS machine_code,
-                m.name AS machine_name,
-                dr.shift,
-                SUM(dr.quantity_defective) AS total_defective,
-                CASE
-                    WHEN SUM(dr.quantity_produced) > 0
-                    THEN ROUND(SUM(dr.quantity_defective)::NUMERIC / SUM(dr.quantity_produced) * 1000000, 2)
-                    ELSE 0
-                END AS ppm
-            FROM defect_records dr
-            JOIN machines m ON m.id = dr.machine_id
-            WHERE {where}
-            GROUP BY m.code, m.name, dr.shift
-            ORDER BY total_defective DESC
-        """
-        rows = db.session.execute(text(sql), params).fetchall()
+        rows = db.session.execute(_SQL_HEATMAP, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+        }).fetchall()
         return [
             {
                 "machine_code": r.machine_code,
@@ -321,15 +436,117 @@ class QualityMetricsService:
             for r in rows
         ]
 
+    @staticmethod
+    def get_all(factory_id: int, start_date=None, end_date=None) -> dict:
+        """get_comprehensive_metrics memoized for the current request.
+
+        Endpoints that compose several metric slices over the same range
+        (the monthly report, dashboards) hit the comprehensive statement
+        once per request instead of once per slice.
+        """
+        if not has_request_context():
+            return QualityMetricsService.get_comprehensive_metrics(
+                factory_id, start_date, end_date)
+        cache = getattr(g, "_metrics_cache", None)
+        if cache is None:
+            cache = g._metrics_cache = {}
+        key = (factory_id, str(start_date), str(end_date))
+        if key not in cache:
+            cache[key] = QualityMetricsService.get_comprehensive_metrics(
+                factory_id, start_date, end_date)
+        return cache[key]
+
     @staticmethod
     def get_comprehensive_metrics(factory_id: int, start_date=None, end_date=None) -> dict:
-        """Returns all quality metrics in a single call."""
+        """Returns all quality metrics in a single call (one DB round-trip)."""
+        row = db.session.execute(_SQL_COMPREHENSIVE, {
+            "factory_id": factory_id,
+            "start_date": start_date,
+            "end_date": end_date,
+        }).fetchone()
+
+        drt = row.dr_totals or {}
+        prt = row.pr_totals or {}
+
+        total_defective = int(drt.get("total_defective") or 0)
+        total_produced = int(drt.get("total_produced") or 0)
+        ppm = round(total_defective / total_produced * 1000000, 2) if total_produced else 0
+
+        total_time = float(prt.get("total_time") or 0)
+        total_downtime = float(prt.get("total_downtime") or 0)
+        total_planned = float(prt.get("total_planned") or 0)
+        total_actual = float(prt.get("total_actual") or 0)
+        pr_defective = float(prt.get("total_defective") or 0)
+
+        availability = round((total_time - total_downtime) / total_time, 4) if total_time else 0
+        performance = round(total_actual / total_planned, 4) if total_planned else 0
+        good_units = total_actual - pr_defective
+        quality = round(good_units / total_actual, 4) if total_actual else 0
+        oee = round(availability * performance * quality, 4)
+
+        pareto_total = sum(int(p["total_defective"] or 0) for p in row.pareto)
+        pareto = []
+        cumulative = 0
+        for p in row.pareto:
+            count = int(p["total_defective"] or 0)
+            cumulative += count
+            pareto.append({
+                "code": p["code"],
+                "description": p["description"],
+                "category": p["category"],
+                "severity_level": p["severity_level"],
+                "total_defective": count,
+                "occurrence_count": int(p["occurrence_count"]),
+                "percentage": round(count / pareto_total * 100, 2) if pareto_total else 0,
+                "cumulative_pct": round(cumulative / pareto_total * 100, 2) if pareto_total else 0,
+            })
+
         return {
-            "ppm": QualityMetricsService.calculate_ppm(factory_id, start_date, end_date),
-            "defect_rate": QualityMetricsService.calculate_defect_rate(factory_id, start_date, end_date),
-            "first_pass_yield": QualityMetricsService.calculate_first_pass_yield(factory_id, start_date, end_date),
-            "oee": QualityMetricsService.calculate_oee(factory_id, start_date, end_date),
-            "trend": QualityMetricsService.calculate_trend(factory_id, days=30),
-            "pareto": QualityMetricsService.calculate_defect_distribution(factory_id, start_date, end_date),
-            "heatmap": QualityMetricsService.get_machine_heatmap(factory_id, start_date, end_date),
+            "ppm": {
+                "ppm": float(ppm),
+                "total_defective": total_defective,
+                "total_produced": total_produced,
+            },
+            "defect_rate": {
+                "defect_rate_pct": round(total_defective / total_produced * 100, 4) if total_produced else 0,
+                "total_defective": total_defective,
+                "total_produced": total_produced,
+            },
+            "first_pass_yield": {
+                "first_pass_yield_pct": round(good_units / total_actual * 100, 4) if total_actual else 0,
+                "good_units": int(good_units),
+                "total_produced": int(total_actual),
+                "total_defective": int(pr_defective),
+            },
+            "oee": {
+                "oee": oee,
+                "oee_pct": round(oee * 100, 2),
+                "availability": availability,
+                "availability_pct": round(availability * 100, 2),
+                "performance": performance,
+                "performance_pct": round(performance * 100, 2),
+                "quality": quality,
+                "quality_pct": round(quality * 100, 2),
+            },
+            "trend": [
+                {
+                    "period": str(t["period"]),
+                    "ppm": float(t["ppm"] or 0),
+                    "defect_rate": float(t["defect_rate"] or 0),
+                    "total_defective": int(t["total_defective"] or 0),
+                    "total_produced": int(t["total_produced"] or 0),
+                }
+                for t in row.trend
+            ],
+            "pareto": pareto,
+            "heatmap": [
+                {
+                    "machine_code": h["machine_code"],
+                    "machine_name": h["machine_name"],
+                    "shift": h["shift"],
+                    "total_defective": int(h["total_defective"] or 0),
+                    "ppm": float(h["ppm"] or 0),
+                }
+                for h in row.heatmap
+            ],
         }
@@ -2,19 +2,77 @@
 SPC — Statistical Process Control Engine
 X-bar charts, R-charts, Cp/Cpk, Nelson rules, process stability
 """
-import math
 import logging
 from typing import List, Optional, Dict
+import numpy as np
 from sqlalchemy import text
 from models import db
 
 logger = logging.getLogger(__name__)
 
-# Western Electric / Nelson rule constants
-A2 = {2:1.880,3:1.023,4:0.729,5:0.577,6:0.483,7:0.419,8:0.373,9:0.337,10:0.308}
-D3 = {2:0,3:0,4:0,5:0,6:0,7:0.076,8:0.136,9:0.184,10:0.223}
-D4 = {2:3.267,3:2.574,4:2.282,5:2.114,6:2.004,7:1.924,8:1.864,9:1.816,10:1.777}
-d2 = {2:1.128,3:1.693,4:2.059,5:2.326,6:2.534,7:2.704,8:2.847,9:2.970,10:3.078}
+# Western Electric / Nelson rule constants, indexed by sample size
+# (2..10). Arrays instead of dicts: plain index lookup, and usable as
+# constants inside compiled kernels.
+A2_ARR = np.zeros(11)
+A2_ARR[2:11] = [1.880, 1.023, 0.729, 0.577, 0.483, 0.419, 0.373, 0.337, 0.308]
+D3_ARR = np.zeros(11)
+D3_ARR[2:11] = [0, 0, 0, 0, 0, 0.076, 0.136, 0.184, 0.223]
+D4_ARR = np.zeros(11)
+D4_ARR[2:11] = [3.267, 2.574, 2.282, 2.114, 2.004, 1.924, 1.864, 1.816, 1.777]
+D2_ARR = np.zeros(11)
+D2_ARR[2:11] = [1.128, 1.693, 2.059, 2.326, 2.534, 2.704, 2.847, 2.970, 3.078]
+
+
+def _nelson_scan(values, mean):
+    """Nelson rules 2 and 3 over a float64 array.
+
+    Returns two int8 arrays the length of `values`: r2[i] is +1/-1 when
+    the 9-point window starting at i sits entirely above/below the
+    mean, r3[i] is +1/-1 when the 6-point window starting at i is
+    strictly increasing/decreasing. Kept as a standalone array-in,
+    array-out kernel so the caller only does cheap dict assembly.
+    """
+    n = values.shape[0]
+    r2 = np.zeros(n, np.int8)
+    r3 = np.zeros(n, np.int8)
+
+    # Single-pass run-length counters instead of re-checking a full
+    # window per position: a window of 9 starting at j-8 is all-above
+    # exactly when the above-run ending at j reaches 9 (same for rule 3
+    # with runs of 5 same-sign diffs). O(N) instead of O(N*window).
+    above = values > mean
+    below = values < mean
+    run_above = run_below = 0
+    for j in range(n):
+        if above[j]:
+            run_above += 1
+            run_below = 0
+        elif below[j]:
+            run_below += 1
+            run_above = 0
+        else:
+            run_above = run_below = 0
+        if run_above >= 9:
+            r2[j - 8] = 1
+        elif run_below >= 9:
+            r2[j - 8] = -1
+
+    d = np.sign(np.diff(values))
+    run_inc = run_dec = 0
+    for j in range(n - 1):
+        if d[j] > 0:
+            run_inc += 1
+            run_dec = 0
+        elif d[j] < 0:
+            run_dec += 1
+            run_inc = 0
+        else:
+            run_inc = run_dec = 0
+        if run_inc >= 5:
+            r3[j - 4] = 1
+        elif run_dec >= 5:
+            r3[j - 4] = -1
+    return r2, r3
 
 
 class SPCService:
@@ -26,32 +84,39 @@ class SPCService:
         Cp = (USL - LSL) / (6σ)
         Cpk = min((USL - μ)/(3σ), (μ - LSL)/(3σ))
         """
+        # Mean/variance reduce in the database over the 500-reading
+        # window — two floats cross the wire instead of 500 rows
         sql = """
-            SELECT metric_value FROM sensor_data
-            WHERE factory_id = :fid
-              AND device_id IN (SELECT id FROM iot_devices WHERE machine_id = :mid AND factory_id = :fid)
-              AND metric_name = :metric
-              AND recorded_at >= NOW() - INTERVAL ':days days'
-              AND quality_flag = 'good'
-            ORDER BY recorded_at DESC
-            LIMIT 500
+            SELECT AVG(metric_value) AS mean,
+                   VAR_SAMP(metric_value) AS variance,
+                   COUNT(*) AS n
+            FROM (
+                SELECT s.metric_value
+                FROM sensor_data s
+                JOIN iot_devices d ON d.id = s.device_id
+                                  AND d.machine_id = :mid AND d.factory_id = :fid
+                WHERE s.factory_id = :fid
+                  AND s.metric_name = :metric
+                  AND s.recorded_at >= NOW() - make_interval(days => :days)
+                  AND s.quality_flag = 'good'
+                ORDER BY s.recorded_at DESC
+                LIMIT 500
+            ) t
         """
-        rows = db.session.execute(text(sql), {
+        row = db.session.execute(text(sql), {
             "fid": factory_id, "mid": machine_id,
             "metric": metric, "days": days
-        }).fetchall()
+        }).fetchone()
 
-        values = [float(r.metric_value) for r in rows]
-        if len(values) < 10:
+        n = int(row.n or 0)
+        if n < 10:
             # Return demo values if insufficient data
             return SPCService._demo_cpk(usl, lsl)
 
-        n = len(values)
-        mean = sum(values) / n
-        variance = sum((x - mean)**2 for x in values) / (n - 1)
-        sigma = math.sqrt(variance)
+        mean = float(row.mean)
+        sigma = float(row.variance or 0) ** 0.5
 
-        if sigma == 0:
+        if np.isclose(sigma, 0):
             return {"error": "Zero variance in data"}
 
         cp = (usl - lsl) / (6 * sigma)
@@ -106,14 +171,15 @@ class SPCService:
         Generates X-bar and R chart data with control limits.
         """
         sql = """
-            SELECT metric_value, recorded_at
-            FROM sensor_data
-            WHERE factory_id = :fid
-              AND device_id IN (SELECT id FROM iot_devices WHERE machine_id = :mid AND factory_id = :fid)
-              AND metric_name = :metric
-              AND recorded_at >= NOW() - INTERVAL ':days days'
-              AND quality_flag = 'good'
-            ORDER BY recorded_at ASC
+            SELECT s.metric_value, s.recorded_at
+            FROM sensor_data s
+            JOIN iot_devices d ON d.id = s.device_id
+                              AND d.machine_id = :mid AND d.factory_id = :fid
+            WHERE s.factory_id = :fid
+              AND s.metric_name = :metric
+              AND s.recorded_at >= NOW() - make_interval(days => :days)
+              AND s.quality_flag = 'good'
+            ORDER BY s.recorded_at ASC
             LIMIT 1000
         """
         rows = db.session.execute(text(sql), {
@@ -121,58 +187,61 @@ class SPCService:
             "metric": metric, "days": days
         }).fetchall()
 
-        values = [float(r.metric_value) for r in rows]
+        values = np.fromiter((r.metric_value for r in rows),
+                             dtype=np.float64, count=len(rows))
 
         if len(values) < sample_size * 3:
             return SPCService._demo_control_chart(sample_size)
 
-        # Group into subgroups
+        # Reshape into (subgroups x sample_size) and reduce along rows —
+        # vectorized means/ranges instead of per-subgroup Python passes
         n = sample_size
-        subgroups = []
-        for i in range(0, len(values) - n + 1, n):
-            group = values[i:i+n]
-            subgroups.append({
-                "mean": sum(group)/n,
-                "range": max(group) - min(group),
-                "values": group
-            })
-
-        if not subgroups:
+        m = len(values) // n
+        if m == 0:
             return SPCService._demo_control_chart(sample_size)
+        arr = values[:m * n].reshape(m, n)
+        means = arr.mean(axis=1)
+        ranges = arr.max(axis=1) - arr.min(axis=1)
 
-        xbar_bar = sum(s["mean"] for s in subgroups) / len(subgroups)
-        r_bar = sum(s["range"] for s in subgroups) / len(subgroups)
+        xbar_bar = float(means.mean())
+        r_bar = float(ranges.mean())
 
-        a2 = A2.get(n, 0.577)
-        d3 = D3.get(n, 0)
-        d4 = D4.get(n, 2.114)
+        in_table = 2 <= n <= 10
+        a2 = float(A2_ARR[n]) if in_table else 0.577
+        d3 = float(D3_ARR[n]) if in_table else 0
+        d4 = float(D4_ARR[n]) if in_table else 2.114
 
         xbar_ucl = xbar_bar + a2 * r_bar
         xbar_lcl = xbar_bar - a2 * r_bar
         r_ucl = d4 * r_bar
         r_lcl = d3 * r_bar
 
-        xbar_points = []
-        r_points = []
-        for i, s in enumerate(subgroups):
-            out_xbar = s["mean"] > xbar_ucl or s["mean"] < xbar_lcl
-            out_r = s["range"] > r_ucl or s["range"] < r_lcl
-            xbar_points.append({
-                "x": i, "y": round(s["mean"], 4),
-                "out_of_control": out_xbar,
-                "violation": "Beyond control limits" if out_xbar else None
-            })
-            r_points.append({
-                "x": i, "y": round(s["range"], 4),
-                "out_of_control": out_r
-            })
-
-        ooc_count = sum(1 for p in xbar_points if p["out_of_control"])
+        # Out-of-control tests as boolean masks over the whole series;
+        # the per-point loop is left with nothing but dict assembly
+        ooc_xbar = (means > xbar_ucl) | (means < xbar_lcl)
+        ooc_r = (ranges > r_ucl) | (ranges < r_lcl)
+
+        # Round each column once in C instead of a round() call per point
+        means_r = np.round(means, 4).tolist()
+        ranges_r = np.round(ranges, 4).tolist()
+
+        xbar_points = [
+            {"x": i, "y": y,
+             "out_of_control": o,
+             "violation": "Beyond control limits" if o else None}
+            for i, (y, o) in enumerate(zip(means_r, ooc_xbar.tolist()))
+        ]
+        r_points = [
+            {"x": i, "y": y, "out_of_control": o}
+            for i, (y, o) in enumerate(zip(ranges_r, ooc_r.tolist()))
+        ]
+
+        ooc_count = int(ooc_xbar.sum())
 
         return {
             "metric": metric,
             "sample_size": n,
-            "subgroup_count": len(subgroups),
+            "subgroup_count": m,
             "xbar_chart": {
                 "ucl": round(xbar_ucl, 4),
                 "lcl": round(xbar_lcl, 4),
@@ -191,23 +260,28 @@ class SPCService:
 
     @staticmethod
     def _demo_control_chart(sample_size=5):
-        import random
-        random.seed(42)
+        # Seeded generator fills both series in two C calls instead of
+        # 40 per-point random.gauss dispatches
+        rng = np.random.default_rng(42)
         center = 50.0
         sigma = 1.5
         ucl = center + 3 * sigma
         lcl = center - 3 * sigma
-        points = []
-        for i in range(20):
-            val = center + random.gauss(0, sigma * 0.8)
-            if i in [5, 13]:
-                val = ucl + random.uniform(0.2, 0.8)
-            points.append({"x": i, "y": round(val, 3), "out_of_control": val > ucl or val < lcl, "violation": "Beyond limits" if val > ucl or val < lcl else None})
+        vals = center + rng.normal(0, sigma * 0.8, 20)
+        vals[[5, 13]] = ucl + rng.uniform(0.2, 0.8, 2)
+        r_vals = np.abs(rng.normal(1.8, 0.4, 20))
+        points = [
+            {"x": i, "y": y, "out_of_control": v > ucl or v < lcl,
+             "violation": "Beyond limits" if v > ucl or v < lcl else None}
+            for i, (v, y) in enumerate(zip(vals.tolist(),
+                                           np.round(vals, 3).tolist()))
+        ]
         return {
             "metric": "demo_metric", "sample_size": sample_size, "subgroup_count": 20,
             "xbar_chart": {"ucl": round(ucl,3), "lcl": round(lcl,3), "center": center, "points": points},
             "r_chart": {"ucl": round(3.6,3), "lcl": 0, "center": round(1.8,3),
-                        "points": [{"x":i,"y":round(abs(random.gauss(1.8,0.4)),3),"out_of_control":False} for i in range(20)]},
+                        "points": [{"x": i, "y": y, "out_of_control": False}
+                                   for i, y in enumerate(np.round(r_vals, 3).tolist())]},
             "process_stable": False, "out_of_control_points": 2, "note": "Demo data"
         }
 
@@ -219,45 +293,38 @@ class SPCService:
         Nelson rule 3: 6 points in a row steadily increasing/decreasing.
         """
         sql = """
-            SELECT metric_value FROM sensor_data
-            WHERE factory_id = :fid
-              AND device_id IN (SELECT id FROM iot_devices WHERE machine_id = :mid AND factory_id = :fid)
-              AND metric_name = :metric
-              AND recorded_at >= NOW() - INTERVAL ':days days'
-              AND quality_flag = 'good'
-            ORDER BY recorded_at ASC LIMIT 200
+            SELECT s.metric_value
+            FROM sensor_data s
+            JOIN iot_devices d ON d.id = s.device_id
+                              AND d.machine_id = :mid AND d.factory_id = :fid
+            WHERE s.factory_id = :fid
+              AND s.metric_name = :metric
+              AND s.recorded_at >= NOW() - make_interval(days => :days)
+              AND s.quality_flag = 'good'
+            ORDER BY s.recorded_at ASC LIMIT 200
         """
         rows = db.session.execute(text(sql), {
             "fid": factory_id, "mid": machine_id,
             "metric": metric, "days": days
         }).fetchall()
-        values = [float(r.metric_value) for r in rows]
+        values = np.fromiter((r.metric_value for r in rows),
+                             dtype=np.float64, count=len(rows))
 
         if len(values) < 9:
             return {"shift_detected": False, "message": "Insufficient data"}
 
-        mean = sum(values) / len(values)
-        violations = []
+        mean = float(values.mean())
+        r2, r3 = _nelson_scan(values, mean)
 
-        # Nelson Rule 2: 9 consecutive same side
-        for i in range(len(values) - 8):
-            window = values[i:i+9]
-            above = all(v > mean for v in window)
-            below = all(v < mean for v in window)
-            if above:
-                violations.append({"rule": 2, "position": i, "type": "9 points above mean", "severity": "high"})
-            elif below:
-                violations.append({"rule": 2, "position": i, "type": "9 points below mean", "severity": "high"})
-
-        # Nelson Rule 3: 6 monotonically increasing/decreasing
-        for i in range(len(values) - 5):
-            window = values[i:i+6]
-            increasing = all(window[j] < window[j+1] for j in range(5))
-            decreasing = all(window[j] > window[j+1] for j in range(5))
-            if increasing:
-                violations.append({"rule": 3, "position": i, "type": "6 points trending up", "severity": "medium"})
-            elif decreasing:
-                violations.append({"rule": 3, "position": i, "type": "6 points trending down", "severity": "medium"})
+        violations = []
+        for i in np.flatnonzero(r2):
+            side = "above" if r2[i] > 0 else "below"
+            violations.append({"rule": 2, "position": int(i),
+                               "type": f"9 points {side} mean", "severity": "high"})
+        for i in np.flatnonzero(r3):
+            direction = "up" if r3[i] > 0 else "down"
+            violations.append({"rule": 3, "position": int(i),
+                               "type": f"6 points trending {direction}", "severity": "medium"})
 
         return {
             "shift_detected": len(violations) > 0,
@@ -276,7 +343,7 @@ class SPCService:
             FROM spc_samples ss
             JOIN spc_control_charts cc ON cc.id = ss.chart_id
             WHERE cc.factory_id = :fid
-              AND ss.sampled_at >= NOW() - INTERVAL ':days days'
+              AND ss.sampled_at >= NOW() - make_interval(days => :days)
         """
         row = db.session.execute(text(sql), {"fid": factory_id, "days": days}).fetchone()
         total = int(row.total or 1)
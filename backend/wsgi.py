@@ -1,9 +1,42 @@
+import os
+
+# eventlet.monkey_patch() rewrites socket/ssl/select/threading process-
+# wide and routes every DB syscall through the eventlet hub — psycopg2
+# runs noticeably faster on native sockets. Only patch when eventlet
+# WebSocket workers are explicitly requested; plain sync workers run
+# unpatched.
+if os.environ.get('QMS_USE_EVENTLET') == '1':
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        pass
+
 from app import create_app
 
-# create_app بيرجع (app, socketio)
-app, socketio = create_app()
+# create_app بيرجع (app, socketio) — built once per process, however
+# many times this module gets imported (dev reloaders, test suites).
+_app = None
+_socketio = None
+
+
+def get_app():
+    global _app, _socketio
+    if _app is None:
+        _app, _socketio = create_app()
+    return _app
+
 
-application = app
+if os.environ.get('QMS_LAZY_APP') == '1':
+    # Defer create_app() until the first request so `import wsgi` stays
+    # near-instant (useful for tests that never hit the app)
+    def application(environ, start_response):
+        return get_app().wsgi_app(environ, start_response)
+    app = None
+    socketio = None
+else:
+    application = app = get_app()
+    socketio = _socketio
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+    get_app().run(host='0.0.0.0', port=8000)
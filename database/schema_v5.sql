@@ -0,0 +1,226 @@
+-- QMS Enterprise v5 — Performance Schema
+-- Indexing and lookup-path changes for hot auth/query paths
+
+-- ── Refresh Tokens — digest lookup column ────────────────────────────
+-- Lookups go through a 32-byte SHA-256 digest instead of the ~250-byte
+-- JWT string: tighter B-tree, more entries per page.
+ALTER TABLE refresh_tokens
+    ADD COLUMN IF NOT EXISTS token_sha256 BYTEA;
+
+UPDATE refresh_tokens SET token_sha256 = sha256(token::bytea)
+WHERE token_sha256 IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_refresh_tokens_token_sha256
+    ON refresh_tokens(token_sha256);
+
+-- ── Refresh Tokens — live-token revocation scan ──────────────────────
+-- Password reset revokes only tokens still live; the partial index
+-- keeps that scan off already-revoked rows.
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_live
+    ON refresh_tokens(user_id) WHERE revoked = FALSE;
+
+-- ── Chatbot / dashboard aggregate scans ──────────────────────────────
+-- Every _answer_* aggregate filters on (factory_id, defect_date range,
+-- deleted_at IS NULL). Partial covering indexes let those run as
+-- index-only range scans instead of filtered heap scans.
+CREATE INDEX IF NOT EXISTS idx_defect_records_factory_date
+    ON defect_records (factory_id, defect_date)
+    INCLUDE (quantity_defective, quantity_produced, shift, defect_code_id, machine_id)
+    WHERE deleted_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_production_records_factory_date
+    ON production_records (factory_id, production_date)
+    INCLUDE (actual_time_minutes, downtime_minutes, planned_quantity, actual_quantity)
+    WHERE deleted_at IS NULL;
+
+-- Unacknowledged-alert count over the last 24h
+CREATE INDEX IF NOT EXISTS idx_anomaly_alerts_factory_open
+    ON anomaly_alerts (factory_id, created_at)
+    WHERE acknowledged = FALSE;
+
+-- ── Daily rollup for chatbot metrics ─────────────────────────────────
+-- PPM / trend / shift answers re-aggregated raw defect_records on every
+-- question. This rollup is days x shifts x codes (tens of rows per
+-- factory-month). NULL shift/code are coalesced so the unique index
+-- covers every row, which REFRESH CONCURRENTLY requires.
+CREATE MATERIALIZED VIEW IF NOT EXISTS factory_daily_metrics AS
+SELECT factory_id,
+       defect_date,
+       COALESCE(shift, 'unknown')   AS shift,
+       COALESCE(defect_code_id, 0)  AS defect_code_id,
+       SUM(quantity_defective)      AS def,
+       SUM(quantity_produced)       AS prod
+FROM defect_records
+WHERE deleted_at IS NULL
+GROUP BY 1, 2, 3, 4;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_factory_daily_metrics_key
+    ON factory_daily_metrics (factory_id, defect_date, shift, defect_code_id);
+
+-- ── sensor_data as a TimescaleDB hypertable (optional) ───────────────
+-- sensor_data grows unboundedly and every summary query rescans raw
+-- rows. Where the timescaledb extension is installed, convert it to a
+-- day-chunked hypertable with a 1-minute continuous aggregate; range
+-- queries then prune to recent chunks and the summary can read the
+-- rollup. Guarded so plain-Postgres deployments (the Railway default)
+-- run this file unchanged.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'timescaledb') THEN
+        PERFORM create_hypertable('sensor_data', 'recorded_at',
+                                  chunk_time_interval => INTERVAL '1 day',
+                                  migrate_data => TRUE,
+                                  if_not_exists => TRUE);
+    END IF;
+END $$;
+
+-- Continuous aggregates cannot be created inside a DO block; run this
+-- separately on Timescale-enabled deployments:
+--
+--   CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_1m
+--   WITH (timescaledb.continuous) AS
+--   SELECT device_id, metric_name,
+--          time_bucket('1 minute', recorded_at) AS bucket,
+--          last(metric_value, recorded_at) AS metric_value,
+--          last(unit, recorded_at)         AS unit
+--   FROM sensor_data
+--   GROUP BY device_id, metric_name, bucket;
+
+-- ── Latest-reading lookups on sensor_data ────────────────────────────
+-- Backs the DISTINCT ON (device_id, metric_name) summary query: one
+-- ordered index scan replaces a LATERAL probe per device.
+CREATE INDEX IF NOT EXISTS idx_sensor_data_dev_metric_time
+    ON sensor_data (device_id, metric_name, recorded_at DESC);
+
+-- ── Quality rollup for dashboard PPM ─────────────────────────────────
+-- Dashboards poll PPM every few seconds; serving it from a per-day,
+-- per-machine rollup makes the query a small index range scan and the
+-- raw-row scan cost is paid once per refresh instead of per poll.
+-- machine_id is coalesced so the unique index covers every row
+-- (required by REFRESH CONCURRENTLY).
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_factory_quality AS
+SELECT factory_id,
+       COALESCE(machine_id, 0) AS machine_id,
+       defect_date             AS day,
+       SUM(quantity_defective) AS d,
+       SUM(quantity_produced)  AS p
+FROM defect_records
+WHERE deleted_at IS NULL
+GROUP BY 1, 2, 3;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_factory_quality_key
+    ON mv_factory_quality (factory_id, machine_id, day);
+
+-- ── Risk-score upsert target ─────────────────────────────────────────
+-- generate_risk_scores used ON CONFLICT DO NOTHING with no conflict
+-- target; with no matching unique constraint every run appended a new
+-- active row per machine — unbounded bloat that every read then had to
+-- scan past. Deactivate duplicate active rows (keep the newest), then
+-- enforce one active score per machine.
+UPDATE risk_scores a
+SET is_active = FALSE
+FROM risk_scores b
+WHERE a.is_active = TRUE AND b.is_active = TRUE
+  AND a.machine_id = b.machine_id AND a.factory_id = b.factory_id
+  AND a.id < b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS risk_scores_active_uidx
+    ON risk_scores (machine_id, factory_id) WHERE is_active = TRUE;
+
+-- ── Maintenance-event scans ──────────────────────────────────────────
+-- MTBF/failure prediction filter on (factory_id, machine_id) and
+-- aggregate by event_type/started_at.
+CREATE INDEX IF NOT EXISTS idx_maintenance_events_fact_mach
+    ON maintenance_events (factory_id, machine_id, event_type, started_at);
+-- ── Per-production-record defect sums ────────────────────────────────
+-- FPY/OEE probe defect_records by production_record_id via LATERAL;
+-- the partial index makes each probe a few-page lookup.
+CREATE INDEX IF NOT EXISTS idx_defect_records_prod_record
+    ON defect_records (production_record_id)
+    INCLUDE (quantity_defective)
+    WHERE deleted_at IS NULL;
+-- ── sensor_data compression (TimescaleDB only) ───────────────────────
+-- Sensor readings are append-only and rarely re-read after a day;
+-- columnar compression segmented by (device_id, metric_name) cuts
+-- chunk storage ~10-20x and speeds cold range scans. Guarded the same
+-- way as the hypertable conversion above so plain Postgres is a no-op.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'timescaledb') THEN
+        EXECUTE $sql$
+            ALTER TABLE sensor_data SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'device_id, metric_name',
+                timescaledb.compress_orderby = 'recorded_at DESC'
+            )
+        $sql$;
+        PERFORM add_compression_policy('sensor_data', INTERVAL '1 day',
+                                       if_not_exists => TRUE);
+    END IF;
+END $$;
+-- ── Daily report roll-ups ────────────────────────────────────────────
+-- get_daily_report re-aggregated production_records and defect_records
+-- on every call even for long-closed days. These roll-ups hold one row
+-- per factory-day (or factory-day-machine); closed-day reports become
+-- single-row lookups and the scan cost is paid once per refresh.
+-- Refresh nightly after day rollover (ReportService.refresh_rollups).
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_production_summary AS
+SELECT factory_id,
+       production_date,
+       COUNT(DISTINCT id)         AS total_runs,
+       SUM(planned_quantity)      AS planned,
+       SUM(actual_quantity)       AS actual,
+       SUM(downtime_minutes)      AS total_downtime,
+       COUNT(DISTINCT machine_id) AS machines_active
+FROM production_records
+WHERE deleted_at IS NULL
+GROUP BY 1, 2;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_daily_production_key
+    ON mv_daily_production_summary (factory_id, production_date);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_defect_summary AS
+SELECT factory_id,
+       defect_date,
+       SUM(quantity_defective)    AS total_defective,
+       SUM(quantity_produced)     AS total_produced,
+       COUNT(DISTINCT id)         AS defect_records,
+       COUNT(DISTINCT machine_id) AS machines_with_defects
+FROM defect_records
+WHERE deleted_at IS NULL
+GROUP BY 1, 2;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_daily_defect_key
+    ON mv_daily_defect_summary (factory_id, defect_date);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_machine_performance AS
+SELECT pr.factory_id,
+       pr.production_date,
+       m.id AS machine_id,
+       m.code,
+       m.name,
+       SUM(pr.actual_quantity)       AS produced,
+       SUM(pr.downtime_minutes)      AS downtime,
+       COALESCE(SUM(ds.defective), 0) AS defective
+FROM production_records pr
+JOIN machines m ON m.id = pr.machine_id
+LEFT JOIN (
+    SELECT machine_id, factory_id, defect_date, SUM(quantity_defective) AS defective
+    FROM defect_records
+    WHERE deleted_at IS NULL
+    GROUP BY 1, 2, 3
+) ds ON ds.machine_id = pr.machine_id
+    AND ds.factory_id = pr.factory_id
+    AND ds.defect_date = pr.production_date
+WHERE pr.deleted_at IS NULL
+GROUP BY 1, 2, 3, 4, 5;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_daily_machine_key
+    ON mv_daily_machine_performance (factory_id, production_date, machine_id);
+-- ── SPC window scans on sensor_data ──────────────────────────────────
+-- Cpk / control-chart / shift-detection all read good-quality readings
+-- for one machine's devices over a recent window; this partial index
+-- lets those run as ordered range scans.
+CREATE INDEX IF NOT EXISTS idx_sensor_data_spc_window
+    ON sensor_data (factory_id, device_id, metric_name, recorded_at DESC)
+    WHERE quality_flag = 'good';